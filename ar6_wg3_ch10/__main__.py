@@ -7,15 +7,23 @@ output/.
 """
 import logging
 import logging.config
-from importlib import import_module
 from itertools import product
 from pathlib import Path
-from traceback import print_exc
 
 import click
 import yaml
 
-from .common import DATA_PATH, FINAL, NOW, OUTPUT_PATH, REMOTE_DATA
+from .common import (
+    CACHE_OPTIONS,
+    DATA_PATH,
+    FINAL,
+    LOCAL_DATA,
+    NOW,
+    OUTPUT_PATH,
+    READ_OPTIONS,
+    REMOTE_DATA,
+    REMOTE_OPTIONS,
+)
 
 log = logging.getLogger(__name__)
 
@@ -32,12 +40,52 @@ def _start_log():
 @click.option(
     "--verbose", is_flag=True, help="Also print DEBUG log messages to stdout."
 )
-def cli(skip_cache, verbose):
+@click.option(
+    "--chunksize",
+    type=int,
+    default=None,
+    help="Read local data in chunks of this many rows, to limit memory use.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["pandas", "arrow"]),
+    default="pandas",
+    help="Parser for CSV files; 'arrow' is multi-threaded.",
+)
+@click.option(
+    "--cache-memory",
+    type=int,
+    default=CACHE_OPTIONS["memory"] // 2 ** 20,
+    show_default=True,
+    help="Hold up to this many MiB of cached data in memory; 0 to disable.",
+)
+@click.option(
+    "--cache-disk",
+    type=int,
+    default=CACHE_OPTIONS["disk"] // 2 ** 20,
+    show_default=True,
+    help="Keep cache files within this many MiB; see 'cache prune'.",
+)
+@click.option(
+    "--cache-format",
+    type=click.Choice(["arrow", "parquet", "pickle"]),
+    default=CACHE_OPTIONS["format"],
+    show_default=True,
+    help="Format of new cache files for data frames.",
+)
+def cli(
+    skip_cache, verbose, chunksize, engine, cache_memory, cache_disk, cache_format
+):
     LC["handlers"]["file"]["filename"] = OUTPUT_PATH / f"{NOW}.log"
 
     if verbose:
         LC["handlers"]["console"]["level"] = "DEBUG"
 
+    READ_OPTIONS.update(chunksize=chunksize, engine=engine)
+    CACHE_OPTIONS.update(
+        memory=cache_memory * 2 ** 20, disk=cache_disk * 2 ** 20, format=cache_format
+    )
+
     if skip_cache:
         from . import util
 
@@ -47,36 +95,278 @@ def cli(skip_cache, verbose):
 @cli.command()
 @click.argument("action", type=click.Choice(["refresh", "compile"]))
 @click.argument("source", type=click.Choice(REMOTE_DATA.keys()))
-def remote(action, source):
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=REMOTE_OPTIONS["jobs"],
+    show_default=True,
+    help="Number of concurrent downloads.",
+)
+@click.option(
+    "--rate",
+    type=float,
+    default=REMOTE_OPTIONS["rate"],
+    show_default=True,
+    help="Maximum requests per second.",
+)
+@click.option(
+    "--batch",
+    type=int,
+    default=REMOTE_OPTIONS["batch"],
+    show_default=True,
+    help="Maximum runs per request; 1 to disable batching.",
+)
+@click.option("--url", help="Base URL of the authentication API, e.g. a local server.")
+def remote(action, source, jobs, rate, batch, url):
     """Retrive data from remote databases to data/cache/SOURCE/.
 
-    An HDF5 file named all.h5 is also created to speed retrieval.
+    "refresh" downloads the data. An interrupted refresh can be resumed by running it
+    again.
 
     \b
-    The download takes:
-    - AR6: ~60 minutes for 895 scenarios / 3.3 GiB. all.h5 is 9.1 GiB.
+    The download takes, with --jobs=1:
+    - AR6: ~60 minutes for 895 scenarios / 3.3 GiB.
     - SR15: ~15 minutes for 416 scenarios / 832 MiB.
+
+    "compile" merges the downloaded data into one Parquet dataset, all.parquet,
+    partitioned by variable, to speed retrieval. get_data() uses it until the next
+    refresh.
     """
     _start_log()
 
-    from cache import cache_data
+    from .cache import cache_data, compile_data
+
+    REMOTE_OPTIONS.update(jobs=jobs, rate=rate, batch=batch)
+    if url:
+        REMOTE_OPTIONS.update(auth_url=url)
 
     if action == "refresh":
-        cache_data(source)
+        if cache_data(source):
+            raise click.ClickException("Some runs failed to download")
     else:
-        print("Please clear the cache manually.")
-        raise NotImplementedError
+        compile_data(source)
+
+
+@cli.command("bench-remote")
+@click.option("--runs", default=20, show_default=True, help="Number of runs.")
+@click.option(
+    "--variables", default=200, show_default=True, help="Variables in each run."
+)
+@click.option("--regions", default=10, show_default=True, help="Regions in each run.")
+@click.option(
+    "--latency", default=0.05, show_default=True, help="Seconds before each response."
+)
+@click.option(
+    "--error-rate", default=0.0, show_default=True, help="Fraction of HTTP 500 errors."
+)
+@click.option("--throttle", type=float, help="Requests per second before HTTP 429.")
+@click.option(
+    "--jobs",
+    "-j",
+    default=REMOTE_OPTIONS["jobs"],
+    show_default=True,
+    help="Number of concurrent downloads.",
+)
+@click.option(
+    "--rate",
+    default=REMOTE_OPTIONS["rate"],
+    show_default=True,
+    help="Maximum requests per second.",
+)
+@click.option(
+    "--batch",
+    type=int,
+    default=REMOTE_OPTIONS["batch"],
+    show_default=True,
+    help="Maximum runs per request; 1 to disable batching.",
+)
+def bench_remote(jobs, rate, batch, **options):
+    """Benchmark 'remote refresh' against a local stand-in server.
+
+    A server with synthetic data is started in a separate process; see
+    iiasa_se_server.py. All its runs are retrieved to a temporary directory, and the
+    throughput is reported: runs per second, and megabytes per second transferred
+    (compressed) and written.
+    """
+    _start_log()
+
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+
+    import requests
+
+    from .cache import SUFFIX, cache_data
+    from .iiasa_se_server import serve_process
+
+    url, server = serve_process(**options)
+    REMOTE_OPTIONS.update(auth_url=f"{url}/auth", jobs=jobs, rate=rate, batch=batch)
+
+    with TemporaryDirectory() as tmp:
+        start = perf_counter()
+        failed = cache_data("AR6 raw", cache_path=Path(tmp))
+        elapsed = perf_counter() - start
+        written = sum(p.stat().st_size for p in Path(tmp).glob(f"*{SUFFIX}"))
+
+    stats = requests.get(f"{url}/stats").json()
+    server.terminate()
+
+    N = options["runs"] - len(failed)
+    print(
+        f"{N} of {options['runs']} runs in {elapsed:.2f} s using {jobs} job(s)",
+        f"  {N / elapsed:.2f} runs/s",
+        f"  {stats['bytes'] / elapsed / 1e6:.2f} MB/s transferred "
+        f"({stats['bytes'] / 1e6:.1f} MB)",
+        f"  {written / elapsed / 1e6:.2f} MB/s written ({written / 1e6:.1f} MB)",
+        f"  {stats['requests']} requests; {stats['errors']} errors and "
+        f"{stats['throttled']} throttled responses injected",
+        sep="\n",
+    )
+
+
+@cli.command()
+@click.argument(
+    "sources", metavar="SOURCES", type=click.Choice(LOCAL_DATA.keys()), nargs=-1
+)
+@click.option(
+    "--in-place",
+    is_flag=True,
+    help="Rewrite files as block-gzip with a sidecar index, instead of Parquet.",
+)
+def ingest(sources, in_place):
+    """Convert local data files to Parquet datasets.
+
+    SOURCES are keys of LOCAL_DATA, e.g. "AR6 world"; default all AR6 snapshots. Each
+    dataset is written next to the original file, partitioned by variable. get_data()
+    reads the dataset instead of the CSV file, as long as the latter is unchanged.
+
+    With --in-place, no second copy of the data is kept. Instead, each file is sorted
+    by variable and rewritten in independently compressed blocks. The result is still a
+    valid .csv.gz file, plus a small index file from which get_data() locates the
+    blocks holding particular variables and regions.
+    """
+    _start_log()
+
+    from .data import id_vars
+    from .store import write_blocks, write_parquet
+
+    for source in sources or filter(lambda s: s.startswith("AR6 "), LOCAL_DATA):
+        path = DATA_PATH / LOCAL_DATA[source]
+        if ".csv" not in path.suffixes:
+            continue
+        elif not path.exists():
+            log.info(f"Skip {source!r}; {path} does not exist")
+            continue
+        elif in_place and path.suffix != ".gz":
+            log.info(f"Skip {source!r}; {path} is not gzipped")
+            continue
+
+        (write_blocks if in_place else write_parquet)(path, id_vars(source))
 
 
 @cli.command(name="clear-cache")
 @click.argument("pattern")
 def clear_cache(pattern):
     """Clear cached/intermediate data matching PATTERN."""
+    from .caching import SUFFIXES, remove
     from .common import DATA_PATH
 
-    for path in DATA_PATH.joinpath("cache").glob(f"{pattern}*.pkl"):
-        print(path)
-        path.unlink()
+    for path in sorted(DATA_PATH.joinpath("cache").glob(f"{pattern}*")):
+        if path.suffix in SUFFIXES:
+            print(path)
+            remove([path.stem])
+
+
+@cli.group()
+def cache():
+    """Inspect and prune cached/intermediate data in data/cache/."""
+
+
+def _format_entries(info):
+    """Format :func:`.caching.entries` for display."""
+    import pandas as pd
+
+    now = pd.Timestamp.now(tz="UTC").tz_localize(None)
+    return pd.DataFrame(
+        {
+            "function": info["function"],
+            "hash": info["name"].str.rsplit("-", n=1).str[-1].str[:8],
+            "MB": (info["size"] / 1e6).round(1),
+            "age": (now - info["created"]).dt.floor("min"),
+            "unused for": (now - info["used"]).dt.floor("min"),
+            "hits": info["hits"],
+            "seconds": info["seconds"].round(1),
+        }
+    )
+
+
+@cache.command("ls")
+@click.argument("pattern", required=False)
+@click.option(
+    "--sort",
+    type=click.Choice(["used", "created", "size", "hits", "seconds", "function"]),
+    default="used",
+    show_default=True,
+    help="Sort by this column.",
+)
+def cache_ls(pattern, sort):
+    """List cache files, optionally those whose names match PATTERN.
+
+    For each file, show the originating function, size, age, time since last use,
+    number of hits, and time taken to compute the data.
+    """
+    from .caching import entries
+
+    info = entries(pattern).sort_values(sort, ascending=sort in ("function", "used"))
+    print(_format_entries(info).to_string(index=False))
+
+
+@cache.command("stats")
+def cache_stats():
+    """Show the number and size of cache files for each function."""
+    from .caching import entries
+
+    info = entries()
+    summary = info.groupby("function").agg(
+        files=("name", "count"),
+        MB=("size", lambda s: round(s.sum() / 1e6, 1)),
+        hits=("hits", "sum"),
+        seconds=("seconds", "sum"),
+    )
+    print(
+        summary.to_string(),
+        "",
+        f"Total {len(info)} files, {info['size'].sum() / 1e6:.1f} MB of "
+        f"{CACHE_OPTIONS['disk'] / 1e6:.1f} MB; policy {CACHE_OPTIONS['policy']!r}",
+        sep="\n",
+    )
+
+
+@cache.command("prune")
+@click.option(
+    "--max-size",
+    type=int,
+    help="Remove files until their total size is at most this many MiB. Default: "
+    "--cache-disk.",
+)
+@click.option(
+    "--policy",
+    type=click.Choice(["lru", "cost"]),
+    default=CACHE_OPTIONS["policy"],
+    show_default=True,
+    help="Remove least recently used, or least costly to recompute, files first.",
+)
+@click.option("--dry-run", is_flag=True, help="Only show the files to remove.")
+def cache_prune(max_size, policy, dry_run):
+    """Remove cache files to stay within a size budget."""
+    from .caching import prune
+
+    removed = prune(max_size and max_size * 2 ** 20, policy, dry_run=dry_run)
+    print(_format_entries(removed).to_string(index=False))
+    print(
+        f"{'Would remove' if dry_run else 'Removed'} {len(removed)} file(s), "
+        f"{removed['size'].sum() / 1e6:.1f} MB"
+    )
 
 
 @cli.command()
@@ -180,43 +470,78 @@ def debug():
     callback=lambda ctx, param, value: int(value),
     help="Width of bands, in deciles (default varies by figure)",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Plot several FIGURES in parallel, using this many processes.",
+)
 @click.argument("to_plot", metavar="FIGURES", type=int, nargs=-1)
-def plot(to_plot, **options):
+def plot(to_plot, jobs, **options):
     """Plot figures, writing to output/.
 
     FIGURES is a sequence of ints, e.g. "1 4 5" to plot figures 1, 4, and 5.
 
     Not every option is recognized by every figure.
     """
+    from .caching import MEMORY
+    from .sweep import plot_one, run
+
     _start_log()
 
-    tem_data = options.pop("tem_data")
-    options["sources"] = (
-        f"AR6 {options.pop('ar6_data')}",
-        f"iTEM {tem_data}" if "MIP" in tem_data else tem_data,
-    )
+    options = _figure_options(options)
+
+    if jobs > 1 and len(to_plot) > 1:
+        run([(fig_id, options) for fig_id in to_plot], jobs, LC)
+        return
 
     # Plot each figure
     for fig_id in to_plot:
-        mod = import_module(f".fig_{fig_id}", package="ar6_wg3_ch10")
-        getattr(mod, f"Fig{fig_id}")(options).save()
+        plot_one(fig_id, options)
+
+    log.info(MEMORY.summary())
 
     # # Extra plots: Render and save
     # extra_fn = (output_path / f'extra_{now}').with_suffix('.pdf')
     # p9.save_as_pdf_pages(gen_plots(), extra_fn)
 
 
+def _figure_options(options):
+    """Convert `options` for the "plot" command to options for :class:`.Figure`."""
+    tem_data = options.pop("tem_data")
+    options["sources"] = (
+        f"AR6 {options.pop('ar6_data')}",
+        f"iTEM {tem_data}" if "MIP" in tem_data else tem_data,
+    )
+    return options
+
+
 @cli.command(name="plot-all")
 @click.option(
     "--per-capita", is_flag=True, default=False, help="Compute per-capita ordinate."
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of processes for generating plots in parallel.",
+)
 @click.pass_context
-def plot_all(ctx, **options):
+def plot_all(ctx, jobs, **options):
     """Generate all plots.
 
     Use --skip-cache when the initial data-loading code changes.
     Use --per-capita for e.g. fig_2.
+
+    Failure of any plot does not stop the others. A summary table of successes,
+    failures, and durations is printed at the end.
     """
+    from .sweep import run
+
+    _start_log()
+
     # Comment out entries to reduce the set of plots generated
     figures = [
         1,
@@ -250,18 +575,20 @@ def plot_all(ctx, **options):
         10,
     ]
 
+    # Defaults for other options of the "plot" command
+    defaults = {
+        p.name: p.get_default(ctx)
+        for p in plot.params
+        if p.name not in ("to_plot", "jobs")
+    }
+
+    variants = []
     for f, s, n, r, bw in product(figures, source, normalize, recategorize, bandwidths):
-        options.update(
-            to_plot=[f], ar6_data=s, normalize=n, recategorize=r, bandwidth=bw
-        )
+        variant = dict(defaults, ar6_data=s, normalize=n, recategorize=r, bandwidth=bw)
+        variant.update(options)
+        variants.append((f, _figure_options(variant)))
 
-        try:
-            ctx.invoke(plot, **options)
-        except Exception:
-            # Print the exception, but continue
-            print()
-            print_exc()
-            print()
+    run(variants, jobs, LC)
 
 
 @cli.command()
@@ -385,5 +712,6 @@ def variables():
         write_vars(source, sorted(df["variable"].unique()))
 
 
-# Start the CLI
-cli()
+if __name__ == "__main__":
+    # Start the CLI. The condition prevents this in worker processes; see sweep.py
+    cli()
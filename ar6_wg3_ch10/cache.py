@@ -3,117 +3,800 @@
 As of 2021-08-17, this is mostly unused; the plots are generated using the prepared
 snapshots provided by the AR6 WGIII Chapter 3 scenarios team.
 """
+import gzip
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
+import os
+import shutil
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import ExitStack
 from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import pandas as pd
 from tqdm import tqdm
 
-from common import DATA_PATH, DATE_FORMAT
-from data import _filter, get_client
-from util import cached
+from .common import DATA_PATH, DATE_FORMAT, READ_OPTIONS, REMOTE_OPTIONS
+from .data import apply_filters, id_vars
+from .iiasa_se_client import get_client
+from .store import filter_expression, partitioning
+from .util import cached, fingerprint, read_csv, write_atomic
 
 log = logging.getLogger(__name__)
 
 
 SUFFIX = ".csv.gz"
 
+#: Number of records converted and written at once by :class:`RecordWriter`.
+BATCH_ROWS = 50000
+
+#: Dimensions recorded in the manifest of each run; see :func:`manifest`.
+MANIFEST_DIMS = ("variable", "region", "year")
+
+#: Columns parsed by :func:`_load_csv`. Others, e.g. "meta" and "runId", are skipped.
+COLUMNS = [
+    "model",
+    "scenario",
+    "variable",
+    "region",
+    "unit",
+    "year",
+    "value",
+    "version",
+    "time",
+]
+
+# Enforce types when reading from CSV
+DTYPES = {c: int for c in "year meta runId version".split()}
+DTYPES["time"] = float  # runID 1202 are empty -> NaN -> cannot use int
+DTYPES["scenario"] = str  # runID 0274 contains '1.0' -> float
+
+
+def _download(client, runs: List[dict], cache_path: Path) -> Tuple[dict, int]:
+    """Retrieve data for `runs` in one request, and write each run to its file.
+
+    The records in the response are split by their "runId". The files are written
+    only if the entire response is received, each with its manifest; see
+    :func:`manifest`.
+
+    Returns
+    -------
+    dict
+        For each run ID, the entry in the manifest of all runs; see
+        :func:`load_runs_manifest`.
+    int
+        Number of records received.
+    """
+    filenames = {r["run_id"]: cache_path / f"{r['run_id']:04}{SUFFIX}" for r in runs}
+    tmp = {k: f.with_name(f.name + ".part") for k, f in filenames.items()}
+
+    N = 0
+    try:
+        with ExitStack() as stack:
+            writers = {k: stack.enter_context(RecordWriter(p)) for k, p in tmp.items()}
+            writer = None
+            for record in client.runs_bulk_ts(runs=list(filenames), stream=True):
+                if writer is not writers[record["runId"]]:
+                    # Records for a different run; write out those for the previous
+                    if writer:
+                        writer.flush()
+                    writer = writers[record["runId"]]
+                writer.append(record)
+                N += 1
+    except BaseException:
+        for path in tmp.values():
+            path.unlink(missing_ok=True)
+        raise
+
+    entries = {}
+    for run in runs:
+        filename = filenames[run["run_id"]]
+        os.replace(tmp[run["run_id"]], filename)
+        writer = writers[run["run_id"]]
+        write_manifest(filename, writer.labels, writer.hashes())
+        entries[run["run_id"]] = _entry(run, filename)
+
+    return entries, N
+
+
+class RecordWriter:
+    """Write records to a gzipped CSV file at `path`, `rows` at a time.
+
+    Records are collected into one buffer per column, and converted and written in
+    batches, so that memory use does not depend on the number of records. The file
+    has the same contents as from :meth:`pandas.DataFrame.to_csv` of all the records.
+    The gzip header contains no time stamp, so that identical data give identical
+    files. The records for each variable are also hashed; see :meth:`hashes`.
+
+    Use as a context manager; the last batch is written on exit, unless there is an
+    exception.
+    """
+
+    def __init__(self, path: Path, rows=BATCH_ROWS):
+        self.path = path
+        self.rows = rows
+
+        #: Mapping from each of :data:`MANIFEST_DIMS` to the set of its labels.
+        self.labels: Dict[str, set] = {dim: set() for dim in MANIFEST_DIMS}
+
+        self._columns: Dict[str, list] = {}
+        self._hashes: Dict[str, Any] = {}
+        self._n = 0  # Number of records in the buffers
+        self._N = 0  # Number of records written
+
+    def __enter__(self):
+        self._gz = gzip.GzipFile(self.path, "wb", mtime=0)
+        self._f = io.TextIOWrapper(self._gz, encoding="utf-8", newline="")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            if self._n:
+                self.flush()
+            elif self._N == 0:
+                # No records
+                pd.DataFrame().to_csv(self._f, lineterminator="\n")
+        self._f.close()
+        self._gz.close()
+
+    def append(self, record: dict) -> None:
+        """Add `record`, writing the buffered records if there are `rows`."""
+        if not self._columns:
+            self._columns = {name: [] for name in record}
+        for name, values in self._columns.items():
+            values.append(record.get(name))
+        self._hashes.setdefault(
+            record.get("variable"), hashlib.blake2b(digest_size=16)
+        ).update(json.dumps(record, sort_keys=True, default=str).encode())
+        self._n += 1
+        if self._n == self.rows:
+            self.flush()
+
+    def hashes(self) -> Dict[str, str]:
+        """Return a hash of the records appended for each variable.
+
+        Unlike the hash of the file, these do not change with the data for other
+        variables in the same run; see :func:`cache_data`.
+        """
+        return {str(v): h.hexdigest() for v, h in self._hashes.items() if v}
+
+    def flush(self) -> None:
+        """Convert and write the buffered records."""
+        if not self._n:
+            return
+
+        N, n = self._N, self._n
+        df = pd.DataFrame(self._columns, index=pd.RangeIndex(N, N + n))
+        df.to_csv(self._f, header=N == 0, lineterminator="\n")
+        for dim in filter(lambda d: d in df.columns, MANIFEST_DIMS):
+            self.labels[dim].update(df[dim].dropna().unique())
+
+        self._N += n
+        self._n = 0
+        for values in self._columns.values():
+            values.clear()
+
+
+def write_records(records: Iterable[dict], path: Path, rows=BATCH_ROWS) -> dict:
+    """Write `records` to a gzipped CSV file at `path`, `rows` at a time.
+
+    See :class:`RecordWriter`.
+
+    Returns
+    -------
+    dict
+        Mapping from each of :data:`MANIFEST_DIMS` to the set of its labels.
+    """
+    with RecordWriter(path, rows) as writer:
+        for record in records:
+            writer.append(record)
+    return writer.labels
+
+
+class BatchSize:
+    """Number of runs to retrieve in one request.
+
+    The size is adjusted by additive increase, multiplicative decrease (AIMD) of a
+    limit on the number of records in each response. While requests succeed within
+    `seconds`, the limit increases by :data:`BATCH_ROWS`; when a request fails or is
+    slower, the limit is halved. The number of runs is the limit divided by the mean
+    number of records per run observed so far, between 1 and `maximum`.
+    """
+
+    def __init__(self, seconds: float, maximum: int):
+        self.seconds = seconds
+        self.maximum = maximum
+        self.limit = float(BATCH_ROWS)
+        self._runs = self._records = 0
+
+    def __call__(self) -> int:
+        if not self._records:
+            # Nothing observed yet
+            return 1
+        per_run = self._records / self._runs
+        return int(min(self.maximum, max(1, self.limit // per_run)))
+
+    def success(self, runs: int, records: int, seconds: float) -> None:
+        """Record a response with `records` for `runs` that took `seconds`."""
+        self._runs += runs
+        self._records += records
+        if seconds > self.seconds:
+            self.failure()
+        else:
+            self.limit += BATCH_ROWS
+
+    def failure(self) -> None:
+        """Record a failed request."""
+        self.limit = max(1.0, self.limit / 2)
+
+
+def _entry(run: dict, filename: Path) -> dict:
+    """Return the entry for `run`, cached in `filename`, in the manifest of all runs."""
+    stat = filename.stat()
+    return dict(
+        **_version(run),
+        hash=_hash(filename),
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+    )
+
+
+def _hash(filename: Path) -> str:
+    return hashlib.blake2b(filename.read_bytes(), digest_size=16).hexdigest()
+
+
+def _unaltered(entry: dict, filename: Path) -> bool:
+    """Return :obj:`True` if `filename` exists and has the hash recorded in `entry`.
+
+    The file is hashed only if its size or modification time differ from those
+    recorded. If the hash is the same, the recorded modification time is updated.
+    """
+    try:
+        stat = filename.stat()
+    except FileNotFoundError:
+        return False
+
+    if (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry.get("mtime_ns")):
+        return True
+    elif _hash(filename) != entry["hash"]:
+        return False
+
+    entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return True
+
+
+def _version(run: dict) -> dict:
+    """Return the version and modification or creation date of `run`."""
+    return dict(version=run.get("version"), upd_date=run["upd_date"] or run["cre_date"])
+
+
+def load_runs_manifest(source, cache_path: Path = None) -> dict:
+    """Load the manifest of all cached runs for `source`, or in `cache_path`.
+
+    The manifest, manifest.json, has two keys:
+
+    - "runs": for each cached run ID, the version, the modification date, and the
+      hash, size, and modification time of the cached file.
+    - "revisions": for each variable, a number increased each time a refresh changes
+      the data for that variable in any run. See :func:`load_csv`.
+    """
+    path = (cache_path or DATA_PATH / "cache" / source) / "manifest.json"
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return dict(runs={}, revisions={})
+
+
+def diff_runs(runs: List[dict], info: dict, cache_path: Path):
+    """Compare `runs` from the remote database with the manifest `info`.
+
+    Returns
+    -------
+    list of dict
+        Default runs to download: those not in `info`, with a different version or
+        modification date, or for which the cached file is missing or altered.
+    list of str
+        IDs of runs in `info` to remove: those no longer default runs, or no longer
+        listed in `runs`.
+    """
+    todo, current = [], set()
+    for run in filter(lambda r: r["is_default"], runs):
+        run_id = str(run["run_id"])
+        current.add(run_id)
+        entry = info["runs"].get(run_id)
+        filename = cache_path / f"{run['run_id']:04}{SUFFIX}"
 
-def cache_data(source):
-    """Retrieve data from *source* and cache it locally."""
-    cache_path = DATA_PATH / "cache" / source
+        if entry is None and filename.exists() and _legacy_current(run, filename):
+            # File from before manifest.json existed, and newer than the run; adopt
+            info["runs"][run_id] = _entry(run, filename)
+        elif (
+            entry is None
+            or {k: entry[k] for k in ("version", "upd_date")} != _version(run)
+            or not _unaltered(entry, filename)
+        ):
+            todo.append(run)
+
+    return todo, sorted(set(info["runs"]) - current)
+
+
+def _legacy_current(run: dict, filename: Path) -> bool:
+    """Return :obj:`True` if `filename` was modified after `run`."""
+    updated = datetime.strptime(_version(run)["upd_date"], DATE_FORMAT)
+    return datetime.fromtimestamp(filename.stat().st_mtime) > updated
+
+
+def _variables(filename: Path) -> set:
+    """Return the variables in the cached data `filename`, if it exists."""
+    try:
+        return set(manifest(filename)["variable"])
+    except FileNotFoundError:
+        return set()
+
+
+def _hashes(filename: Path) -> Dict[str, Optional[str]]:
+    """Return hashes of the data for each variable in the cached data `filename`.
+
+    The hash is :obj:`None` for variables with no recorded hash, e.g. in manifests
+    written before hashes were recorded.
+    """
+    try:
+        info = manifest(filename)
+    except FileNotFoundError:
+        return {}
+    return {v: info.get("hashes", {}).get(v) for v in info["variable"]}
+
+
+def _changed(old: Dict[str, Optional[str]], new: Dict[str, Optional[str]]) -> set:
+    """Return variables added, removed, or with different or unknown hashes."""
+    return set(
+        filter(lambda v: old.get(v) is None or old[v] != new.get(v), old.keys() | new)
+    )
+
+
+def manifest_path(filename: Path) -> Path:
+    """Return the path of the manifest for the run data in `filename`."""
+    return filename.with_name(filename.name.replace(SUFFIX, ".json"))
+
+
+def write_manifest(
+    filename: Path, labels: Dict[str, Iterable], hashes: Dict[str, str] = None
+) -> dict:
+    """Write a manifest of the :data:`MANIFEST_DIMS` `labels` in `filename`.
+
+    `hashes`, if given, are hashes of the data for each variable; see
+    :meth:`RecordWriter.hashes`.
+    """
+    stat = filename.stat()
+    info = dict(mtime=stat.st_mtime, size=stat.st_size)
+    for dim in MANIFEST_DIMS:
+        values = labels.get(dim, [])
+        info[dim] = sorted(map(int, values) if dim == "year" else map(str, values))
+    if hashes is not None:
+        info["hashes"] = hashes
+
+    write_atomic(
+        manifest_path(filename), lambda path: path.write_text(json.dumps(info))
+    )
+    return info
+
+
+def manifest(filename: Path) -> dict:
+    """Return the manifest for the run data in `filename`.
+
+    The manifest records the variables, regions, and years that appear in the file. If
+    the manifest is missing or older than the file, e.g. for data retrieved before
+    manifests were introduced, it is created by reading the file.
+    """
+    stat = filename.stat()
+    try:
+        info = json.loads(manifest_path(filename).read_text())
+    except FileNotFoundError:
+        pass
+    else:
+        if (info["mtime"], info["size"]) == (stat.st_mtime, stat.st_size):
+            return info
+
+    usecols = list(filter(lambda c: c in MANIFEST_DIMS, _header(filename)))
+    data = read_csv(filename, usecols=usecols)
+    return write_manifest(filename, {d: data[d].dropna().unique() for d in usecols})
+
+
+def _header(filename: Path) -> List[str]:
+    return pd.read_csv(filename, nrows=0).columns.tolist()
+
+
+def _may_match(info: dict, filters: dict) -> bool:
+    """Return :obj:`True` if data with manifest `info` may match `filters`."""
+    for dim in MANIFEST_DIMS:
+        if dim not in filters:
+            continue
+        values = filters[dim]
+        values = {values} if isinstance(values, (str, int)) else set(values)
+        if dim == "year":
+            values = set(map(int, values))
+        if not values & set(info[dim]):
+            return False
+    return True
+
+
+def _read_run(filename: Path, dims: List[str], filters: dict) -> pd.DataFrame:
+    """Read the run data in `filename`, returning only data matching `filters`.
+
+    Only :data:`COLUMNS` are parsed. Empty runs give an empty data frame.
+    """
+    usecols = list(filter(lambda c: c in COLUMNS, _header(filename)))
+    if "value" not in usecols:
+        # No records, so no columns; see RecordWriter
+        return pd.DataFrame()
+
+    return (
+        read_csv(
+            filename,
+            dtype={c: t for c, t in DTYPES.items() if c in usecols},
+            usecols=usecols,
+        )
+        # Changes in the data format
+        .rename(columns={"time": "subannual"})
+        .pipe(apply_filters, dims, filters)
+    )
+
+
+def _init_reader(options: Dict) -> None:
+    """Apply :data:`.READ_OPTIONS` from the parent process in a worker process."""
+    READ_OPTIONS.update(options)
+
+
+def cache_data(source, jobs=None, cache_path: Path = None):
+    """Retrieve data from *source* and cache it locally, in `cache_path`.
+
+    The list of runs from `source` is compared to the manifest of cached runs; see
+    :func:`diff_runs`. Only new or changed runs are downloaded, and cached data for
+    superseded or deleted runs are removed. The variables with changed data are
+    logged, and their revisions increased; see :func:`load_runs_manifest`. For each
+    downloaded run, these are identified by hashes of the data for each variable, so
+    that a change in one variable does not increase the revisions of the others.
+
+    Runs are downloaded by `jobs` concurrent threads, default
+    :data:`.REMOTE_OPTIONS` ["jobs"], which share a pool of connections; see
+    :func:`.make_session`. Several runs are retrieved in each request, as many as
+    :class:`BatchSize` gives, up to :data:`.REMOTE_OPTIONS` ["batch"]. The runs in a
+    failed request are retried one at a time.
+
+    Each run is written to its file atomically, and the manifest is updated even if
+    some runs fail, so an interrupted or failed refresh can be resumed by running it
+    again.
+
+    The default `cache_path` is :file:`data/cache/{source}`, where :func:`load_csv`
+    reads the data.
+    """
+    cache_path = cache_path or DATA_PATH / "cache" / source
     cache_path.mkdir(parents=True, exist_ok=True)
 
     # List of 'runs' (=scenarios)
     client = get_client(source)
     runs = client.runs(get_only_default_runs=False)
 
-    # Also cache the list of 'runs'
-    json.dump(runs, open(cache_path / "runs.json", "w"))
+    # Also cache the list of 'runs', only if changed; see has_compiled()
+    runs_path = cache_path / "runs.json"
+    if not runs_path.exists() or json.loads(runs_path.read_text()) != runs:
+        write_atomic(runs_path, lambda path: path.write_text(json.dumps(runs)))
+
+    # Identify runs to download and remove
+    info = load_runs_manifest(source, cache_path)
+    todo, prune = diff_runs(runs, info, cache_path)
+    log.info(f"Retrieve {len(todo)} and remove {len(prune)} of {len(runs)} runs")
+
+    changed = set()
+
+    # Remove cached data for superseded runs
+    for run_id in prune:
+        filename = cache_path / f"{int(run_id):04}{SUFFIX}"
+        changed |= _variables(filename)
+        for path in filename, manifest_path(filename):
+            path.unlink(missing_ok=True)
+        info["runs"].pop(run_id)
+
+    # Retrieve concurrently, in batches, displaying a progress bar
+    jobs = jobs or REMOTE_OPTIONS["jobs"]
+    size = BatchSize(REMOTE_OPTIONS["batch_seconds"], REMOTE_OPTIONS["batch"])
+    pending = deque(todo)
+    singles: deque = deque()  # Runs from failed batches, to retry one at a time
+    failed = []
+
+    # Hashes of the data for each variable in any existing data for each run
+    previous = {
+        run["run_id"]: _hashes(cache_path / f"{run['run_id']:04}{SUFFIX}")
+        for run in todo
+    }
+
+    def _timed(runs):
+        start = perf_counter()
+        return _download(client, runs, cache_path), perf_counter() - start
+
+    with ThreadPoolExecutor(jobs) as executor, tqdm(total=len(todo)) as progress:
+        futures: Dict[Future, List[dict]] = {}
+
+        def _submit():
+            while len(futures) < jobs and (singles or pending):
+                if singles:
+                    batch = [singles.popleft()]
+                else:
+                    n = min(size(), len(pending))
+                    batch = [pending.popleft() for _ in range(n)]
+                futures[executor.submit(_timed, batch)] = batch
+
+        _submit()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = futures.pop(future)
+                try:
+                    (entries, records), seconds = future.result()
+                except Exception as e:
+                    size.failure()
+                    if len(batch) > 1:
+                        log.warning(
+                            f"Request for {len(batch)} runs failed; retry one at a "
+                            f"time: {e}"
+                        )
+                        singles.extend(batch)
+                    else:
+                        log.error(
+                            "Run {run_id} ({model}/{scenario}): ".format(**batch[0])
+                            + str(e)
+                        )
+                        failed.append(batch[0]["run_id"])
+                        progress.update()
+                    continue
+
+                size.success(len(batch), records, seconds)
+                for run in batch:
+                    filename = cache_path / f"{run['run_id']:04}{SUFFIX}"
+                    entry = entries[run["run_id"]]
+                    old = info["runs"].get(str(run["run_id"]), {}).get("hash")
+                    if entry["hash"] != old:
+                        changed |= _changed(previous[run["run_id"]], _hashes(filename))
+                    info["runs"][str(run["run_id"])] = entry
+                progress.update(len(batch))
+                progress.set_postfix_str("{model}/{scenario}".format(**batch[-1]))
+
+            _submit()
+
+    # Record revisions of changed variables and update the manifest
+    for variable in changed:
+        info["revisions"][variable] = info["revisions"].get(variable, 0) + 1
+    write_atomic(
+        cache_path / "manifest.json", lambda path: path.write_text(json.dumps(info))
+    )
+
+    log.info(f"Data changed for {len(changed)} variable(s)")
+    for variable in sorted(changed):
+        log.debug(f"  {variable}")
+
+    if failed:
+        log.error(f"{len(failed)} run(s) failed; run again to retry: {failed}")
+
+    return failed
+
+
+def compiled_path(source) -> Path:
+    """Return the path of the consolidated Parquet dataset for `source`."""
+    return DATA_PATH / "cache" / source / "all.parquet"
+
+
+def _cache_state(cache_path: Path) -> str:
+    """Return the fingerprint of the manifest in `cache_path`, or else of runs.json."""
+    manifest = cache_path / "manifest.json"
+    return fingerprint(manifest if manifest.exists() else cache_path / "runs.json")
+
+
+def has_compiled(source) -> bool:
+    """Return :obj:`True` if the dataset for `source` is up to date.
+
+    This is so if the manifest of cached runs, or the list of runs, is unchanged since
+    :func:`compile_data`, and no runs that were then skipped have since been cached.
+    """
+    cache_path = DATA_PATH / "cache" / source
+    try:
+        info = json.loads(compiled_path(source).joinpath("_compiled.json").read_text())
+    except FileNotFoundError:
+        return False
+    return info.get("state") == _cache_state(cache_path) and not any(
+        cache_path.joinpath(name).exists() for name in info.get("skipped", [])
+    )
+
+
+def compile_data(source) -> Path:
+    """Merge all cached runs for `source` into one Parquet dataset, all.parquet.
+
+    The dataset is partitioned by "variable". Within each partition, the data for each
+    run are contiguous and sorted by region. :func:`_load_csv` then reads only the
+    partitions for the requested variables, and filters on other dimensions are
+    pushed down to the Parquet reader.
+
+    Only the data for default runs are included. Runs with no cached data, e.g. those
+    for which ``remote refresh`` failed, are skipped with a warning. Runs are read one
+    at a time, so the memory used does not depend on the total size of the data.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
 
-    # Display a progress bar while downloading
-    runs_iter = tqdm(runs)
+    cache_path = DATA_PATH / "cache" / source
+    target = compiled_path(source)
+    tmp = target.with_name(target.name + ".part")
+    state = _cache_state(cache_path)
 
-    for run in runs_iter:
+    runs = []
+    missing = []
+    for run in json.load(open(cache_path / "runs.json")):
         if not run["is_default"]:
-            # Superseded version of a run; don't download
             continue
-
-        # Modification date or creation date; whichever is more recent
-        try:
-            updated = datetime.strptime(run["upd_date"], DATE_FORMAT)
-        except TypeError:
-            # upd_date is None
-            updated = datetime.strptime(run["cre_date"], DATE_FORMAT)
-
-        # Cache target file
         filename = cache_path / f"{run['run_id']:04}{SUFFIX}"
+        (runs if filename.exists() else missing).append(filename)
 
-        # Update the progress bar
-        runs_iter.set_postfix_str("{model}/{scenario}".format(**run))
+    if missing:
+        log.warning(
+            f"Skip {len(missing)} run(s) with no cached data; run 'remote refresh' "
+            f"to retry: {', '.join(f.name for f in missing)}"
+        )
 
-        try:
-            file_mtime = datetime.fromtimestamp(filename.stat().st_mtime)
-            if file_mtime > updated:
-                continue  # File on disk is newer; skip
-        except FileNotFoundError:
-            pass  # File doesn't exist
+    schema = pa.schema(
+        [
+            (c, pa.int64() if DTYPES.get(c) is int else pa.string())
+            for c in COLUMNS
+            if c not in ("value", "time")
+        ]
+        + [("value", pa.float64()), ("subannual", pa.float64())]
+    )
+
+    def _batches():
+        for filename in tqdm(runs):
+            df = _read_run(filename, [], {})
+            if len(df):
+                df = df.sort_values(["variable", "region", "model", "scenario"])
+                yield from pa.Table.from_pandas(
+                    df, schema=schema, preserve_index=False
+                ).to_batches()
+
+    log.info(f"Compile {len(runs)} runs to {target}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.write_dataset(
+        _batches(),
+        tmp,
+        schema=schema,
+        format="parquet",
+        partitioning=partitioning(),
+        max_partitions=2 ** 16,
+    )
+    # Record the state of the cache and skipped runs; see has_compiled()
+    info = dict(runs=len(runs), state=state, skipped=[f.name for f in missing])
+    tmp.joinpath("_compiled.json").write_text(json.dumps(info))
+
+    # Replace any existing dataset
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+
+    return target
+
+
+def _load_compiled(source, filters) -> pd.DataFrame:
+    """Read data matching `filters` from the dataset written by compile_data()."""
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        compiled_path(source), format="parquet", partitioning=partitioning()
+    )
+    expr = filter_expression(filters, dataset.schema.names)
+    df = dataset.to_table(filter=expr).to_pandas()
+    log.info(f"Read {len(df)} rows from {compiled_path(source)}")
+
+    # Restore the order of columns from _read_run()
+    return df[[c for c in COLUMNS if c != "time"] + ["subannual"]]
+
+
+def revisions(source, variables=None):
+    """Return the revisions of the cached data for `variables` of `source`.
+
+    The result is a mapping from each variable to its revision; see
+    :func:`load_runs_manifest`. If `variables` is :obj:`None`, i.e. all variables,
+    or there is no manifest, a fingerprint of the manifest or list of runs is returned
+    instead.
+    """
+    cache_path = DATA_PATH / "cache" / source
+    result = load_runs_manifest(source)["revisions"]
+    if not result:
+        # No manifest; use the contents of the list of runs
+        return fingerprint(cache_path / "runs.json")
+    elif variables is None:
+        # All variables; use the contents of the manifest
+        return fingerprint(cache_path / "manifest.json")
 
-        # Retrieve, convert to CSV, and write
-        pd.DataFrame.from_dict(client.runs_bulk_ts(runs=[run["run_id"]])).to_csv(
-            filename
-        )
+    variables = [variables] if isinstance(variables, str) else variables
+    return {v: result.get(v, 0) for v in sorted(variables)}
 
 
-def load_csv(source, *args, **kwargs):
-    # Inline the run_info into the arguments so that it is used for the cache key
-    run_info = json.load(open(DATA_PATH / "cache" / source / "runs.json"))
-    return _load_csv(source, run_info, *args, **kwargs)
+def load_csv(source, filters, *args, **kwargs):
+    # Inline the revisions of the requested variables into the arguments, so that they
+    # are used for the cache key. A refresh that changes data for other variables does
+    # not invalidate cached results.
+    return _load_csv(
+        source, revisions(source, filters.get("variable")), filters, *args, **kwargs
+    )
 
 
 @cached
-def _load_csv(source, run_info, filters, default_only=True, **kwargs):
+def _load_csv(source, revisions, filters, default_only=True, **kwargs):
     cache_path = DATA_PATH / "cache" / source
 
-    runs = json.load(open(cache_path / "runs.json"))
-
-    # Enforce types when reading from CSV
-    dtypes = {c: int for c in "year meta runId version".split()}
-    dtypes["time"] = float  # runID 1202 are empty -> NaN -> cannot use int
-    dtypes["scenario"] = str  # runID 0274 contains '1.0' -> float
+    if default_only and has_compiled(source):
+        return _load_compiled(source, filters)
 
-    # Display a progress bar while downloading
-    runs_iter = tqdm(runs)
+    runs = json.load(open(cache_path / "runs.json"))
 
-    # Iterate over files
-    dfs = []
-    N_row = 0
-    for run in runs_iter:
+    # Files for runs that may contain data matching `filters`, according to their
+    # manifests
+    filenames = []
+    for run in runs:
         if default_only and not run["is_default"]:
             continue
 
         filename = cache_path / f"{run['run_id']:04}{SUFFIX}"
-
-        df = (
-            pd.read_csv(filename, index_col=0, dtype=dtypes)
-            .reset_index(drop=True)
-            # Changes in the data format
-            .rename(columns={"time": "subannual"})
-            .pipe(_filter, filters)
+        if not filename.exists():
+            log.warning(f"No cached data for run {run['run_id']}; skipped")
+        elif _may_match(manifest(filename), filters):
+            filenames.append(filename)
+
+    log.info(f"Read {len(filenames)} of {len(runs)} runs that may match filters")
+
+    # Read files in parallel, displaying a progress bar.
+    # - Daemonic processes, e.g. the workers of sweep.run(), cannot have child
+    #   processes; use threads.
+    # - Don't start more processes than files.
+    dims = id_vars(source)
+    dfs = {}
+    N_row = 0
+    workers = max(1, min(len(filenames), os.cpu_count() or 1))
+    if multiprocessing.current_process().daemon or workers == 1:
+        executor = ThreadPoolExecutor(workers)
+    else:
+        # Spawned processes do not have the options of this process, e.g. from the CLI
+        executor = ProcessPoolExecutor(
+            workers, initializer=_init_reader, initargs=(dict(READ_OPTIONS),)
         )
+    with executor:
+        futures = {
+            executor.submit(_read_run, f, dims, filters): i
+            for i, f in enumerate(filenames)
+        }
+        runs_iter = tqdm(as_completed(futures), total=len(futures))
+        for future in runs_iter:
+            df = future.result()
 
-        if len(df) == 0:
-            continue
+            if len(df) == 0:
+                continue
 
-        # Update the progress bar
-        N_row += len(df)
-        runs_iter.set_postfix_str(f"{N_row} obs")
+            # Update the progress bar
+            N_row += len(df)
+            runs_iter.set_postfix_str(f"{N_row} obs")
 
-        dfs.append(df)
+            dfs[futures[future]] = df
 
     if len(dfs):
-        return pd.concat(dfs, copy=False, ignore_index=True)
+        # Concatenate in the order of `runs`
+        return pd.concat([dfs[i] for i in sorted(dfs)], copy=False, ignore_index=True)
     else:
         return pd.DataFrame()
 
@@ -0,0 +1,596 @@
+"""Cache intermediate data in memory and on disk.
+
+:func:`decorate` is compatible with :func:`genno.caching.decorate`: cache files have
+the same names, from hashes of the function code and arguments, so files written by
+genno are read here. Data frames are written in the format given by
+:data:`.CACHE_OPTIONS` ["format"]; by default Arrow IPC, which is read
+memory-mapped: numeric columns refer directly to the operating system's page cache,
+without being copied or decoded, and are shared by processes that read the same file.
+With the "parquet" format, files are also read by genno. Other values are pickled.
+
+In front of the files is a least-recently-used cache in memory, :data:`MEMORY`, so
+that repeated calls within one process do not read the files again.
+
+Several threads or processes may use the cache at once. Each value is computed by only
+one of them, holding :func:`lock` for its name, while the others wait and then read the
+file written. Files are written under temporary names and renamed when complete, so
+they are never read partially written.
+
+For each cache file, metadata are recorded in :file:`data/cache/meta/{name}.json`: the
+originating function, size, time taken to compute, and times of creation and of each
+hit. These are used by :func:`prune` to keep the total size of the files within
+:data:`.CACHE_OPTIONS` ["disk"], and shown by the ``cache`` command.
+"""
+import json
+import logging
+import pickle
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import update_wrapper
+from pathlib import Path
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from genno.caching import hash_args, hash_code
+
+from .common import CACHE_OPTIONS, DATA_PATH
+from .util import write_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger(__name__)
+
+
+class MemoryCache:
+    """Least-recently-used cache of data frames, limited by their size in bytes.
+
+    The limit is :data:`.CACHE_OPTIONS` ["memory"], read each time a value is added.
+    """
+
+    def __init__(self):
+        self._data: Dict[Hashable, Any] = OrderedDict()
+        self._nbytes: Dict[Hashable, int] = {}
+        self._lock = Lock()
+
+        #: Counts of hits, misses, and evictions.
+        self.stats = dict(hits=0, misses=0, evictions=0)
+
+    @property
+    def nbytes(self) -> int:
+        """Total size of the values held."""
+        return sum(self._nbytes.values())
+
+    def get(self, key: Hashable):
+        """Return the value for `key`, or :obj:`None`."""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            return self._data[key]
+
+    def put(self, key: Hashable, value) -> bool:
+        """Store `value` for `key`, evicting the least recently used values.
+
+        Return :obj:`False` if `value` cannot be held, e.g. if larger than the limit.
+        """
+        limit = CACHE_OPTIONS["memory"]
+        size = nbytes(value)
+        with self._lock:
+            self._discard(key)
+            if size is None or size > limit:
+                return False
+            self._data[key], self._nbytes[key] = value, size
+            while self.nbytes > limit:
+                self._discard(next(iter(self._data)))
+                self.stats["evictions"] += 1
+        return True
+
+    def clear(self) -> None:
+        """Remove all values."""
+        with self._lock:
+            self._data.clear()
+            self._nbytes.clear()
+
+    def summary(self) -> str:
+        return (
+            "Memory cache: {hits} hits, {misses} misses, {evictions} evictions; "
+            "{N} values, {MB:.1f} MB"
+        ).format(**self.stats, N=len(self._data), MB=self.nbytes / 1e6)
+
+    def _discard(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+        self._nbytes.pop(key, None)
+
+
+#: Cache in memory for all functions decorated with :func:`decorate`.
+MEMORY = MemoryCache()
+
+
+def nbytes(value) -> Any:
+    """Return the size of `value` in memory, or :obj:`None` if it cannot be held."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True, index=True).sum())
+    elif isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True, index=True))
+    return None
+
+
+def _copy_on_write() -> bool:
+    """Return :obj:`True` if pandas copy-on-write is enabled.
+
+    It is always enabled with pandas 3, and may be enabled with earlier versions.
+    """
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return True
+    try:
+        return pd.get_option("mode.copy_on_write") is True
+    except pd.errors.OptionError:  # pandas < 1.5
+        return False
+
+
+def _view(value):
+    # - With copy-on-write, changes to a shallow copy do not affect `value`, so the
+    #   value held in MEMORY is read-only for callers.
+    # - Otherwise, return `value` itself; callers that change it must copy it first.
+    return value.copy(deep=False) if _copy_on_write() else value
+
+
+#: Locks within this process, by name; see :func:`lock`.
+_LOCKS: Dict[str, Lock] = {}
+_LOCKS_LOCK = Lock()
+
+
+@contextmanager
+def lock(name: str) -> Iterator[None]:
+    """Hold an exclusive lock for `name`, across threads and processes.
+
+    The lock is held on the file :file:`data/cache/locks/{name}.lock`, which is left in
+    place. The lock is not re-entrant: a thread holding it must not acquire it again.
+    """
+    with _LOCKS_LOCK:
+        thread_lock = _LOCKS.setdefault(name, Lock())
+
+    path = DATA_PATH / "cache" / "locks" / f"{name}.lock"
+    with thread_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a+b") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                # LK_LOCK gives up after 10 seconds; keep trying
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            try:
+                yield
+            finally:
+                # Closing the file also releases the lock
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def sorted_values(kwargs: Dict) -> Dict:
+    """Return `kwargs` with lists, tuples, and sets of values sorted, where possible."""
+    result = {}
+    for name, value in kwargs.items():
+        if isinstance(value, (list, tuple, set)):
+            try:
+                value = sorted(value)
+            except TypeError:
+                pass  # Mixed types
+        result[name] = value
+    return result
+
+
+def cache_name(func: Callable, *args, **kwargs) -> str:
+    """Return the name of the cache file, without suffix, for `func` and arguments.
+
+    This is the same as used by :func:`genno.caching.decorate`.
+    """
+    return f"{func.__name__}-{hash_args(*args, hash_code(func), **kwargs)}"
+
+
+def decorate(func: Callable, unordered: bool = False) -> Callable:
+    """Decorate `func` to cache its return values.
+
+    If `unordered` is :obj:`True`, the order of values in lists, tuples, or sets given
+    as keyword arguments does not affect the result of `func`. These are sorted for the
+    cache name only (see :func:`sorted_values`), so that calls differing only in the
+    order share cached values; `func` receives them as given.
+
+    Values are read, in order of preference, from :data:`MEMORY`; from cache files in
+    :file:`data/cache/`; or by calling `func`. Data frames are stored in both.
+
+    If there is no cache file, :func:`lock` is acquired for the cache name before
+    calling `func`, and the cache files checked again. Concurrent calls with the same
+    arguments, in other threads or processes, thus wait for the first to write the
+    file, then read it.
+
+    :data:`.SKIP_CACHE` is checked each time `func` is called. If :obj:`True`, `func`
+    is always called and the cached values replaced. With :data:`.CACHE_OPTIONS`
+    ["memory"] set to 0, :data:`MEMORY` is bypassed.
+
+    Data frames are not copied. Values from :data:`MEMORY` are shallow copies of the
+    held data frame if pandas copy-on-write is enabled, as it always is with pandas 3,
+    or else the held data frame itself. Columns of data frames read from Arrow IPC
+    files are memory-mapped and read-only. Callers that change the returned data in
+    place must first copy it, e.g. with :meth:`pandas.DataFrame.copy`.
+    """
+    log.debug(f"Wrapping {func.__name__} in caching.decorate()")
+
+    def cached_load(*args, **kwargs):
+        from . import util
+
+        key = sorted_values(kwargs) if unordered else kwargs
+        name = cache_name(func, *args, **key)
+        path = DATA_PATH.joinpath("cache", name)
+        short_name = f"{func.__name__}(<{name.split('-')[-1][:8]}…>)"
+        memory = CACHE_OPTIONS["memory"] > 0
+
+        value = None
+        if util.SKIP_CACHE:
+            log.info(f"Skip cache for {short_name}")
+        else:
+            value = MEMORY.get(name) if memory else None
+            if value is not None:
+                log.info(f"Memory cache hit for {short_name}")
+                return _view(value)
+
+            value = _load(name)
+            if value is not None:
+                log.info(f"Cache hit for {short_name}")
+            else:
+                # Also occurs if len(files) >= 2
+                log.info(f"Cache miss for {short_name}")
+
+        if value is None:
+            with lock(name):
+                if not util.SKIP_CACHE:
+                    # Written by another thread or process while waiting for the lock
+                    value = _load(name)
+                    if value is not None:
+                        log.info(f"Cache hit for {short_name} after waiting")
+
+                if value is None:
+                    start = perf_counter()
+                    value = func(*args, **kwargs)
+                    seconds = perf_counter() - start
+                    _write(path, value)
+                    size = sum(p.stat().st_size for p in cache_files(name))
+                    _record(
+                        name,
+                        function=func.__name__,
+                        size=size,
+                        seconds=round(seconds, 3),
+                        created=time(),
+                        used=time(),
+                        hits=0,
+                    )
+                    _written(name, size)
+
+        if isinstance(value, (pd.DataFrame, pd.Series)) and memory:
+            if MEMORY.put(name, value):
+                return _view(value)
+        return value
+
+    update_wrapper(cached_load, func)
+    cached_load.unordered = unordered
+
+    return cached_load
+
+
+def _load(name: str) -> Any:
+    """Read the cache file for `name` and record a hit.
+
+    Returns :obj:`None` if there is not exactly one file.
+    """
+    files = cache_files(name)
+    if len(files) != 1:
+        return None
+
+    try:
+        value = _read(files[0])
+    except FileNotFoundError:
+        # Removed by prune() in another process
+        return None
+
+    _record(name, hit=True, used=time())
+    return value
+
+
+def _read_arrow(path: Path) -> pd.DataFrame:
+    import pyarrow as pa
+
+    # - Map the file into memory; buffers of the table refer to the mapped pages.
+    # - Convert column by column, so that numeric columns refer to the same buffers
+    #   instead of being consolidated into a new 2-D array.
+    table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def _write_arrow(path: Path, data: pd.DataFrame) -> None:
+    import pyarrow as pa
+
+    if not all(isinstance(c, str) for c in data.columns):
+        # Would be converted to str by from_pandas()
+        raise TypeError("column names must be str")
+
+    table = pa.Table.from_pandas(data)
+    # - Store NaN in float columns as such, rather than as nulls, so that the columns
+    #   are read without being copied to fill in NaN.
+    # - Column by column, since from_pandas(…, nan_as_null=False) fails for object
+    #   columns containing NaN.
+    for i, dtype in enumerate(data.dtypes):
+        if isinstance(dtype, np.dtype) and dtype.kind == "f" and table[i].null_count:
+            values = pa.array(data.iloc[:, i].to_numpy(), from_pandas=False)
+            table = table.set_column(i, table.field(i), values)
+    options = pa.ipc.IpcWriteOptions(compression=CACHE_OPTIONS["compression"])
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+
+
+def _write_parquet(path: Path, data: pd.DataFrame) -> None:
+    # Work around https://github.com/dask/fastparquet/issues/730
+    if data.empty and isinstance(data.index, pd.MultiIndex):
+        data.reset_index(drop=True, inplace=True)
+    data.to_parquet(path)
+
+
+def _read_pickle(path: Path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _write_pickle(path: Path, data) -> None:
+    with open(path, "wb") as f:
+        pickle.dump(data, f)
+
+
+#: Functions to write and read cache files, by suffix. Formats for data frames
+#: accept only :class:`pandas.DataFrame`.
+SERIALIZERS: Dict[str, Tuple[Callable, Callable]] = {
+    ".arrow": (_write_arrow, _read_arrow),
+    ".parquet": (_write_parquet, pd.read_parquet),
+    ".pickle": (_write_pickle, _read_pickle),
+    ".pkl": (_write_pickle, _read_pickle),
+}
+
+#: Suffixes of cache files.
+SUFFIXES = tuple(SERIALIZERS)
+
+
+def _read(path: Path):
+    """Read cached data from `path`."""
+    try:
+        return SERIALIZERS[path.suffix][1](path)
+    except KeyError:
+        raise RuntimeError(f"Unknown suffix {path.suffix!r} for cache file")
+
+
+def _write(path: Path, data):
+    """Write `data` to `path`, with a suffix for the format, and return it.
+
+    Data frames are written in the format :data:`.CACHE_OPTIONS` ["format"]; other
+    values, or data frames that cannot be converted, e.g. with columns of mixed types,
+    are pickled. The file is written with a temporary name, then renamed. Existing files
+    for the same name in other formats are then removed.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    suffix = f".{CACHE_OPTIONS['format']}"
+    if not (isinstance(data, pd.DataFrame) and suffix in SERIALIZERS):
+        suffix = ".pickle"
+    target = path.with_suffix(suffix)
+    try:
+        write_atomic(target, lambda tmp: SERIALIZERS[suffix][0](tmp, data))
+    except Exception as e:
+        if suffix == ".pickle":
+            raise
+        log.info(f"Pickle {path.name}; cannot write {suffix!r}: {e!r}")
+        target = path.with_suffix(".pickle")
+        write_atomic(target, lambda tmp: _write_pickle(tmp, data))
+
+    for p in cache_files(path.name):
+        if p != target:
+            p.unlink(missing_ok=True)
+
+    return data
+
+
+def cache_files(name: str) -> List[Path]:
+    """Return the cache file(s) for `name`; see :func:`cache_name`."""
+    return [
+        p for p in DATA_PATH.joinpath("cache").glob(f"{name}.*") if p.suffix in SUFFIXES
+    ]
+
+
+def _meta_path(name: str) -> Path:
+    return DATA_PATH / "cache" / "meta" / f"{name}.json"
+
+
+def _meta(name: str) -> Dict:
+    """Return the recorded metadata for cache file `name`, if any."""
+    try:
+        return json.loads(_meta_path(name).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _record(name: str, hit: bool = False, **values) -> None:
+    """Update the metadata for cache file `name` with `values`.
+
+    If `hit` is :obj:`True`, also increment the number of hits.
+    """
+    path = _meta_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with lock(f"{name}.meta"):
+        # Read, update, and write while holding the lock, so that concurrent updates
+        # are not lost
+        info = dict(_meta(name), **values)
+        if hit:
+            info["hits"] = info.get("hits", 0) + 1
+        write_atomic(path, lambda tmp: tmp.write_text(json.dumps(info)))
+
+
+def entries(pattern: Optional[str] = None) -> pd.DataFrame:
+    """Return information about cache files, optionally those matching `pattern`.
+
+    `pattern` is a regular expression matched against the start of the file name,
+    i.e. the name of the originating function. Files without recorded metadata,
+    e.g. from :func:`genno.caching.decorate`, are included, with their modification
+    time as the time of creation and last use.
+
+    Returns
+    -------
+    pandas.DataFrame
+        With columns "name", "function", "size" (bytes), "seconds" (to compute;
+        :obj:`NaN` if unknown), "created", "used" (time stamps), "hits", and "path".
+    """
+    columns = ["name", "function", "size", "seconds", "created", "used", "hits"]
+    rows = []
+    cache_dir = DATA_PATH.joinpath("cache")
+    for path in sorted(cache_dir.iterdir() if cache_dir.exists() else []):
+        if path.suffix not in SUFFIXES or not path.is_file():
+            continue
+        name = path.stem
+        if pattern and not re.match(pattern, name):
+            continue
+
+        stat = path.stat()
+        info = dict(
+            name=name,
+            function=name.rsplit("-", 1)[0],
+            size=stat.st_size,
+            seconds=float("nan"),
+            created=stat.st_mtime,
+            used=stat.st_mtime,
+            hits=0,
+        )
+        info.update(_meta(name))
+        rows.append(dict({c: info[c] for c in columns}, path=path))
+
+    result = pd.DataFrame(rows, columns=columns + ["path"])
+    for column in "created", "used":
+        result[column] = pd.to_datetime(result[column], unit="s")
+    return result
+
+
+def remove(names: List[str]) -> None:
+    """Remove the cache files and metadata for `names`, also from :data:`MEMORY`."""
+    for name in names:
+        for path in cache_files(name) + [_meta_path(name)]:
+            path.unlink(missing_ok=True)
+        with MEMORY._lock:
+            MEMORY._discard(name)
+
+
+#: Fraction of :data:`.CACHE_OPTIONS` ["disk"] to which :func:`_written` prunes the
+#: files, so that it does not prune again for every file written.
+PRUNE_FRACTION = 0.9
+
+#: Total size of cache files, in bytes, counted by :func:`_written`.
+_DISK_SIZE: Optional[int] = None
+_DISK_SIZE_LOCK = Lock()
+
+
+def _written(name: str, size: int) -> None:
+    """Add `size` of the file just written for `name` to the total; prune if needed.
+
+    The files are counted only for the first file written by this process, and again
+    after :func:`prune`, rather than for every file. Files written or removed by other
+    processes in the meantime are not counted. If the total exceeds
+    :data:`.CACHE_OPTIONS` ["disk"], files are pruned to :data:`PRUNE_FRACTION` of it.
+    """
+    global _DISK_SIZE
+
+    with _DISK_SIZE_LOCK:
+        if _DISK_SIZE is None:
+            cache_dir = DATA_PATH.joinpath("cache")
+            _DISK_SIZE = sum(
+                p.stat().st_size for p in cache_dir.iterdir() if p.suffix in SUFFIXES
+            )
+        else:
+            _DISK_SIZE += size
+
+        if _DISK_SIZE > CACHE_OPTIONS["disk"]:
+            prune(int(CACHE_OPTIONS["disk"] * PRUNE_FRACTION), keep=name)
+            _DISK_SIZE = None
+
+
+def prune(
+    max_size: Optional[int] = None,
+    policy: Optional[str] = None,
+    keep: Optional[str] = None,
+    dry_run: bool = False,
+) -> pd.DataFrame:
+    """Remove cache files until their total size is at most `max_size`.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Size in bytes; default :data:`.CACHE_OPTIONS` ["disk"].
+    policy : str, optional
+        Order in which to remove files; default :data:`.CACHE_OPTIONS` ["policy"].
+
+        - "lru": least recently used first.
+        - "cost": least costly to recompute first. The cost is the time recorded to
+          compute the data, times 1 plus the number of hits, per byte of the file.
+          Files with no recorded time are removed first, then by last use.
+    keep : str, optional
+        Name of a cache file not to remove, e.g. one just written.
+    dry_run : bool, optional
+        Only return the files that would be removed.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The removed files; see :func:`entries`.
+    """
+    max_size = CACHE_OPTIONS["disk"] if max_size is None else max_size
+    policy = policy or CACHE_OPTIONS["policy"]
+
+    info = entries()
+    excess = info["size"].sum() - max_size
+    if excess <= 0:
+        return info.iloc[:0]
+
+    if policy == "lru":
+        order = info.sort_values("used")
+    elif policy == "cost":
+        cost = info["seconds"].fillna(0) * (1 + info["hits"]) / info["size"].clip(1)
+        order = info.assign(_cost=cost).sort_values(["_cost", "used"]).drop(
+            columns="_cost"
+        )
+    else:
+        raise ValueError(f"policy={policy!r}")
+
+    order = order[order["name"] != keep]
+    removed = order[order["size"].cumsum().shift(fill_value=0) < excess]
+
+    if not dry_run:
+        log.info(
+            f"Remove {len(removed)} cache file(s), {removed['size'].sum() / 1e6:.1f} "
+            f"MB, to keep within {max_size / 1e6:.1f} MB"
+        )
+        remove(removed["name"].tolist())
+
+    return removed
@@ -6,7 +6,7 @@ from collections import ChainMap
 from datetime import datetime
 from functools import partial
 from pathlib import Path
-from typing import Dict, Iterable, List, Sequence
+from typing import Dict, Iterable, List, Optional, Sequence
 from zipfile import ZIP_DEFLATED, ZipFile
 
 import matplotlib as mpl
@@ -26,6 +26,30 @@ DATA_PATH = (Path(__file__).parents[1] / "data").resolve()
 OUTPUT_PATH = Path("output")
 SKIP_CACHE = False
 
+# Options for reading data files; set from the command line
+READ_OPTIONS = dict(
+    # Read local CSV files in chunks of this many rows, instead of all at once
+    chunksize=None,
+    # Parser for CSV files: "pandas" or "arrow"; see util.read_csv()
+    engine="pandas",
+)
+
+# Options for cached intermediate data; see caching.py
+CACHE_OPTIONS = dict(
+    # Maximum total size, in bytes, of cached data also held in memory; 0 to bypass
+    memory=2 * 2 ** 30,
+    # Maximum total size, in bytes, of cache files, and the order in which files are
+    # removed to stay within it: "lru" or "cost". See caching.prune().
+    disk=20 * 2 ** 30,
+    policy="lru",
+    # Format of cache files for data frames: "arrow" (Arrow IPC, read memory-mapped),
+    # "parquet", or "pickle"; other values are always pickled. See caching._write().
+    format="arrow",
+    # Compression of Arrow IPC files: None, "lz4", or "zstd". Compressed files are
+    # smaller, but must be decompressed into memory when read.
+    compression=None,
+)
+
 # Paths for local data files
 LOCAL_DATA = {
     # Obtained from the AR6 Scenario Explorer "Downloads" page
@@ -59,6 +83,25 @@ REMOTE_DATA = {
     "SR15 raw": "IXSE_SR15",
 }
 
+# Options for requests to the remote databases; set from the command line
+REMOTE_OPTIONS = dict(
+    # Base URL of the authentication API. Set e.g. to the URL of a local server.
+    auth_url="https://db1.ene.iiasa.ac.at/EneAuth/config/v1",
+    # Number of concurrent downloads
+    jobs=4,
+    # Maximum number of requests per second to any one host
+    rate=10.0,
+    # Number of retries for failed requests, and factor for exponential backoff
+    retries=5,
+    backoff=0.5,
+    # Timeout in seconds for each request
+    timeout=300,
+    # Maximum number of runs retrieved in one request; 1 to disable batching. The
+    # size of batches is adjusted to take about `batch_seconds` per request.
+    batch=50,
+    batch_seconds=5.0,
+)
+
 # Dates
 NOW = datetime.now().isoformat(timespec="seconds")
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
@@ -428,11 +471,26 @@ class Figure:
             )
         )
 
-        # Set years filter
-        self.filters["year"] = self.years
+        # Set years filter. Copy, rather than modify, the class attribute.
+        self.filters = dict(self.filters, year=self.years)
 
         # Store figure size: 190 mm in inches, aspect ratio from a property
-        self.geoms.append(p9.theme(figure_size=(7.48, 7.48 * self.aspect_ratio)))
+        self.geoms = self.geoms + [
+            p9.theme(figure_size=(7.48, 7.48 * self.aspect_ratio))
+        ]
+
+    @classmethod
+    def load_key(cls, options: Dict) -> tuple:
+        """Return a key for the data loaded by :meth:`load_data`, given `options`.
+
+        Variants of a figure with equal keys load identical data; see sweep.plan().
+        Options applied after loading, e.g. "recategorize", are not part of the key.
+        """
+        return (
+            cls.__name__,
+            tuple(options["sources"]),
+            cls.has_option.get("per_capita", False) and options.get("per_capita"),
+        )
 
     def format_title(self, **kwargs):
         """Return a :func:`plotnine.ggtitle` from :attr:`title` with `kwargs`."""
@@ -441,46 +499,69 @@ class Figure:
         template = f"{self.title} [{self.units}]"
         return p9.ggtitle(template.format(**kwargs))
 
-    def _prepare_data(self):
-        from .data import get_data, split_scenarios
-        from .util import restore_dims
+    def load_data(self) -> Dict[str, pd.DataFrame]:
+        """Load IAM, population, and G-/NTEM data for the figure.
+
+        The result depends only on :meth:`load_key`, and is not modified by
+        :meth:`_prepare_data`. It can be loaded once and given to :meth:`save` for
+        several variants.
+        """
+        from .data import get_data
 
-        # Temporary storage for data
         data = {}
 
         # Arguments for get_data()
-        args = dict(variable=self.variables, recategorize=self.recategorize)
+        args = dict(variable=self.variables)
         args.update(self.filters)
 
-        # - Load IAM data.
+        # Load IAM data
+        data["iam"] = get_data(source=self.sources[0], **args)
+
+        if self.has_option.get("per_capita", False) and self.per_capita:
+            # Load population data for per capita calculations
+            pop_args = args.copy()
+            pop_args["variable"] = ["Population"]
+            data["population"] = get_data(source=self.sources[0], **pop_args)
+        else:
+            data["population"] = pd.DataFrame()
+
+        # Load G-/NTEM data
+        data["tem"] = get_data(source=self.sources[1], conform_to="AR6", **args)
+
+        return data
+
+    def _prepare_data(self, data: Optional[Dict[str, pd.DataFrame]] = None):
+        from .data import regroup_categories, split_scenarios
+        from .util import restore_dims
+
+        # Load data, unless given. Use copies so `data` can be reused.
+        data = {k: v.copy() for k, v in (data or self.load_data()).items()}
+
+        # Recategorize IAM data, according to (command-line) option
+        if self.recategorize and self.sources[0].startswith("AR6"):
+            for key in filter(lambda k: len(data[k]), ("iam", "population")):
+                data[key] = regroup_categories(data[key], self.recategorize)
+
         # - Restore additional dimensions, according to class properties.
         # - Remove categorical columns.
         # - Drop NCA data, according to (command-line) option.
         data["iam"] = (
-            get_data(source=self.sources[0], **args)
+            data["iam"]
             .pipe(restore_dims, self.restore_dims)
             .pipe(remove_categoricals)
             .pipe(drop_nca_if, not self.include_nca)
         )
-        if self.has_option.get("per_capita", False) and self.per_capita:
-            # Load population data for per capita calculations
-            pop_args = args.copy()
-            pop_args["variable"] = ["Population"]
-            data["population"] = get_data(source=self.sources[0], **pop_args).replace(
+        if len(data["population"]):
+            data["population"] = data["population"].replace(
                 {"unit": {"Million": "million"}}
             )
-        else:
-            data["population"] = pd.DataFrame()
 
         # Split national (NTEM) and sectoral (GTEM) models
         data["ns"], data["iam"] = split_scenarios(
             data["iam"], groups=["national", "sectoral"]
         )
 
-        # Load G-/NTEM data
-        data["tem"] = get_data(source=self.sources[1], conform_to="AR6", **args).pipe(
-            remove_categoricals
-        )
+        data["tem"] = data["tem"].pipe(remove_categoricals)
 
         # Merge item and ns data
         if len(data["ns"]):
@@ -521,8 +602,12 @@ class Figure:
     def generate(self):
         """Must be implemented by subclasses."""
 
-    def save(self):
-        self._prepare_data()
+    def save(self, data: Optional[Dict[str, pd.DataFrame]] = None):
+        """Prepare data, generate plots, and save to file.
+
+        If `data` is given, it is used instead of calling :meth:`load_data`.
+        """
+        self._prepare_data(data)
 
         if self.load_only:
             return
@@ -1,21 +1,27 @@
 """Load and process data."""
+import json
 import logging
 from copy import copy
 from itertools import chain
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
-from . import item
+from . import item, store
 from .common import (
+    BW_STAT,
     CAT_GROUP,
     DATA_PATH,
     FUEL_GROUP,
     LOCAL_DATA,
+    READ_OPTIONS,
     SCENARIOS,
     REMOTE_DATA,
 )
-from .util import cached, unique_units
+from .util import cached, fingerprint, read_csv, unique_units
 
 log = logging.getLogger(__name__)
 
@@ -50,14 +56,68 @@ def aggregate_fuels(df: pd.DataFrame, groupby=[]) -> pd.DataFrame:
     )
 
 
-def compute_descriptives(df, on=["variable"], groupby=[]):
-    """Compute descriptive statistics on `df`."""
-    return (
-        df.groupby(on + ["year", "category"] + groupby)
-        .describe(percentiles=[0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95])
-        .loc[:, "value"]
-        .reset_index()
-    )
+#: Statistics computed by compute_descriptives(), labeled as by pd.DataFrame.describe().
+STATS = {
+    "min": 0.0,
+    "5%": 0.05,
+    "10%": 0.1,
+    "25%": 0.25,
+    "50%": 0.5,
+    "75%": 0.75,
+    "90%": 0.9,
+    "95%": 0.95,
+    "max": 1.0,
+}
+
+
+def compute_descriptives(df, on=["variable"], groupby=[], bandwidth=None):
+    """Compute descriptive statistics on `df`.
+
+    The result has the columns `on`, "year", "category", `groupby`, "count", and each
+    of :data:`STATS`. Quantiles are interpolated linearly, as by
+    pd.DataFrame.describe(); NaN values are ignored.
+
+    Parameters
+    ----------
+    bandwidth : int, optional
+        If given, compute only the quartiles and the statistics for `bandwidth` in
+        :data:`BW_STAT`.
+    """
+    keys = on + ["year", "category"] + groupby
+    if bandwidth:
+        labels = BW_STAT[bandwidth] + ("25%", "50%", "75%")
+        stats = {k: v for k, v in STATS.items() if k in labels}
+    else:
+        stats = STATS
+
+    # - Number each group, in the same order as groupby().
+    # - Discard rows with missing values in `keys` or "value".
+    # - Sort values within each group, once.
+    grouped = df.groupby(keys, observed=True)
+    group = grouped.ngroup().to_numpy()
+    value = df["value"].to_numpy(dtype=float)
+    mask = ~(np.isnan(group) | np.isnan(value))
+    group, value = group[mask].astype(int), value[mask]
+    order = np.lexsort((value, group))
+    value = value[order]
+
+    # Number of values and position of the first value for each group
+    count = np.bincount(group, minlength=grouped.ngroups)
+    start = np.concatenate([[0], np.cumsum(count)[:-1]])
+    empty = count == 0
+
+    result = grouped.size().index.to_frame(index=False)
+    result["count"] = count.astype(float)
+    for label, q in stats.items():
+        # Positions of the values on either side of quantile `q` in each group
+        pos = (np.maximum(count, 1) - 1) * q
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        x_lo = value[np.minimum(start + lo, len(value) - 1)] if len(value) else pos
+        x_hi = value[np.minimum(start + hi, len(value) - 1)] if len(value) else pos
+        result[label] = np.where(empty, np.nan, x_lo + (x_hi - x_lo) * (pos - lo))
+
+    return result
 
 
 def filter_fuel_shares(data: pd.DataFrame, groupby=[], atol=0.01) -> pd.DataFrame:
@@ -81,30 +141,51 @@ def filter_fuel_shares(data: pd.DataFrame, groupby=[], atol=0.01) -> pd.DataFram
     # Dimensions for grouping
     id_cols = ["model", "scenario", "region", "year"] + groupby
     # All fuels expected in the output
-    fuels = set(data["fuel"].unique())
-
-    def _key(df):
-        return ", ".join(map(str, df[id_cols].iloc[0, :]))
-
-    def _filter(df):
-        """Filter one group, `df`."""
-        check = df["value"].sum()
-        if abs(check - 1) > atol:
-            log.debug(f"{_key(df)}: drop all data; sum |{check:.3f} - 1| > {atol}")
-            return df.iloc[0:0, :]  # Exclude: return an empty data frame
-
-        # Set of missing fuels
-        missing = fuels - set(df["fuel"])
-        if missing:
-            # Infill using existing data in `df`; overwrite 'fuel' and 'value'
-            log.debug(f"{_key(df)}: infill 0 for non-reported fuel(s) {missing}")
-            return pd.concat(
-                [df, df.iloc[: len(missing), :].assign(value=0, fuel=sorted(missing))],
-            )
-        else:
-            return df
+    fuels = sorted(data["fuel"].unique())
+
+    # - Number each group, in the same order as groupby(). Rows with missing values in
+    #   `id_cols` are dropped, as by groupby().
+    # - Compute the sum of fuel shares in each group, aligned with `data`.
+    grouped = data.groupby(id_cols, observed=True)
+    group = grouped.ngroup()
+    total = grouped["value"].transform("sum")
+    keep = group.notna() & ~((total - 1).abs() > atol)
+
+    dropped = group[group.notna() & ~keep].nunique()
+    if dropped:
+        log.debug(
+            f"Drop all data for {dropped} of {group.nunique()} group(s) with sum of "
+            f"fuel shares |sum - 1| > {atol}"
+        )
 
-    return data.groupby(id_cols).apply(_filter).reset_index(drop=True)
+    # Retained data, ordered by group; original order within each group
+    order = np.argsort(group[keep].to_numpy(), kind="stable")
+    kept = data[keep].iloc[order]
+    kept_group = group[keep].iloc[order].to_numpy().astype(int)
+
+    # (group, fuel) pairs not in the retained data, ordered by group, then fuel
+    full = pd.MultiIndex.from_product([np.unique(kept_group), fuels])
+    missing = full[~full.isin(pd.MultiIndex.from_arrays([kept_group, kept["fuel"]]))]
+    if len(missing):
+        log.debug(
+            f"Infill 0 for {len(missing)} non-reported fuel value(s) in "
+            f"{missing.get_level_values(0).nunique()} group(s)"
+        )
+
+    # Infill using existing data: the i-th missing fuel in each group copies the i-th
+    # row of the group. Overwrite 'fuel' and 'value'
+    miss_group = missing.get_level_values(0).to_numpy()
+    first = np.searchsorted(kept_group, miss_group)
+    size = np.searchsorted(kept_group, miss_group, side="right") - first
+    rank = pd.Series(miss_group).groupby(miss_group).cumcount().to_numpy()
+    infill = kept.iloc[first + np.minimum(rank, size - 1)].assign(
+        value=0, fuel=missing.get_level_values(1)
+    )
+
+    # Combine, with infilled rows following existing rows of the same group
+    result = pd.concat([kept, infill])
+    order = np.argsort(np.concatenate([kept_group, miss_group]), kind="stable")
+    return result.iloc[order].reset_index(drop=True)
 
 
 def per_capita_if(
@@ -296,6 +377,11 @@ def apply_filters(df: pd.DataFrame, dims, filters: Dict) -> pd.DataFrame:
         columns = list(
             filter(lambda c: c in dims or not years or c in years, df.columns)
         )
+        # Rows to retain: those matching filters on dims. Selecting these before
+        # melt() avoids melting data that is then discarded.
+        dim_filters = {k: v for k, v in filters.items() if k in dims}
+        if len(dim_filters):
+            df = df[df[list(dim_filters)].isin(dim_filters).all(axis=1)]
         # - Select matching columns.
         # - Melt.
         # - Convert "year" to integer.
@@ -315,9 +401,24 @@ def apply_filters(df: pd.DataFrame, dims, filters: Dict) -> pd.DataFrame:
     return base[base.isin(filters)[list(filters.keys())].all(axis=1)]
 
 
+def id_vars(source: str) -> List[str]:
+    """Return the names of dimensions in data from `source`.
+
+    These are the identifier variables for pandas melt(); all other columns are years.
+    """
+    result = ["model", "scenario", "region", "variable", "unit"]
+    if "iTEM" in source:
+        # Additional columns in iTEM MIP2 and MIP3
+        result.extend(["mode", "technology", "fuel"])
+    if "MIP3" in source:
+        # Additional columns in iTEM MIP3 data only
+        result.extend(["service", "vehicle_type", "liquid_fuel_type"])
+    return result
+
+
 @cached
-def raw_local_data(path, dims: List[str], mtime: float = 0.0) -> pd.DataFrame:
-    """Load raw local data from a CSV file at `path`.
+def raw_local_data(name: str, dims: List[str], digest: str = "") -> pd.DataFrame:
+    """Load raw local data from the CSV file `name`, relative to :data:`DATA_PATH`.
 
     - Column names matching `dims` except for case are renamed to lower case and
       returned as categoricals.
@@ -326,16 +427,21 @@ def raw_local_data(path, dims: List[str], mtime: float = 0.0) -> pd.DataFrame:
     The returned data frame is in ‘wide’ format, i.e. with the "year" dimension as
     columns; the tranformation to ‘long’ format is done in apply_filters(), above.
     This is done because the data frame is large before filtering, so melt() is slow.
+    To avoid holding the entire data frame in memory, see stream_local_data().
 
     Parameters
     ----------
-    path :
-        Path to load.
+    name :
+        Path to load, relative to :data:`DATA_PATH`, so that cached data are used for
+        other copies of the data directory.
     dims :
         Dimension names.
-    mtime :
-        Last modification time of `path`.
+    digest :
+        Hash of the contents of the file, from :func:`.fingerprint`. Used only as part
+        of the cache key.
     """
+    path = DATA_PATH / name
+
     # Peek at column names
     dtype = {}  # Columns to read as categorical
     rename = {}  # Map for renaming columns
@@ -344,34 +450,69 @@ def raw_local_data(path, dims: List[str], mtime: float = 0.0) -> pd.DataFrame:
         dtype[name] = "category"
 
     # Apply dtypes as data is read, instead of in a separate step
-    return pd.read_csv(path, dtype=dtype).rename(columns=rename)
+    return read_csv(path, dtype=dtype).rename(columns=rename)
+
+
+def stream_local_data(
+    path, dims: List[str], filters: Dict, chunksize: int
+) -> pd.DataFrame:
+    """Load data matching `filters` from a CSV file at `path`, in chunks.
+
+    Unlike raw_local_data(), the file is read in chunks of `chunksize` rows. Each chunk
+    is passed through apply_filters(), so only the matching rows of each chunk are
+    retained, in ‘long’ format. Peak memory use is bounded by the size of one chunk
+    plus the size of the result.
+
+    Column names matching `dims` except for case are renamed to lower case and
+    returned as categoricals.
+    """
+    # Peek at column names
+    columns = pd.read_csv(path, nrows=0).columns
+    rename = {c: c.lower() for c in columns if c.lower() in dims}
+
+    # Columns to parse: dims and any columns matching the "year" filter
+    years = set(map(str, filters.get("year", [])))
+    usecols = list(filter(lambda c: c in rename or not years or c in years, columns))
+
+    log.info(f"Read {path.name} in chunks of {chunksize} rows")
+
+    chunks = []
+    with pd.read_csv(path, usecols=usecols, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunks.append(
+                chunk.rename(columns=rename).pipe(apply_filters, dims, filters)
+            )
+
+    return pd.concat(chunks, ignore_index=True).astype(
+        {d: "category" for d in rename.values()}
+    )
 
 
-@cached
 def get_data(
-    source: str = "AR6",
-    vars_from_file=True,
-    drop=("meta", "runId", "time"),
-    conform_to=None,
-    default_item_filters=True,
-    recategorize=None,
-    **filters,
+    source: str = "AR6", vars_from_file=True, recategorize=None, **kwargs
 ) -> pd.DataFrame:
     """Retrieve and return data for `source`.
 
+    Results are cached. Cached data for the same `source` and other filters, but more
+    variables or years, are subset instead of loading data again; see
+    _get_superset().
+
     Parameters
     ----------
     source
         Source of data; one of the keys in LOCAL_DATA or REMOTE_DATA. In the latter
-        case, the data must have first been cached using ``$ python main.py cache
-        SOURCE``; they are read from the corresponding file all.h5.
+        case, the data must have first been cached using ``$ python -m ar6_wg3_ch10
+        remote refresh SOURCE``. They are read from the dataset all.parquet, if it
+        has been created using ``remote compile SOURCE``, or else from the cached
+        files for each run.
     drop : list of str
         Columns to drop.
     vars_from_file : bool, optional
         Use the list from "data/variables-*source*.txt" if no variables are given with
         `filters`.
     recategorize :
-        Passed to categorize().
+        For AR6 sources, passed to regroup_categories(). This is applied after the
+        data are loaded, so loads with different `recategorize` share one cache entry.
 
     Other parameters
     ----------------
@@ -382,13 +523,151 @@ def get_data(
         Names of variables to retrieve. When *source* includes 'iTEM', a bare
         str for *variables* is used to retrieve *filters* from data/variables-map.yaml.
     """
-    if vars_from_file and "variable" not in filters:
+    if vars_from_file and "variable" not in kwargs:
         # Only load a subset of variables, as defined in a particular file
         variables = (
             (DATA_PATH / f"variables-{source}.txt").read_text().strip().split("\n")
         )
-        filters["variable"] = sorted(variables)
+        kwargs["variable"] = sorted(variables)
+
+    kwargs.update(source=source)
+    result = _get_superset(kwargs)
+    if recategorize and source.startswith("AR6"):
+        result = regroup_categories(result, recategorize)
+    return result
+
+
+def source_revision(source: str, variables=None) -> str:
+    """Return a digest of the input data for `variables` of `source`.
+
+    This includes the data and, if they are categorized, the category metadata; see
+    :func:`.fingerprint`. For remote sources, the data are represented by the
+    revisions of `variables` in the cached runs, which change only when ``remote
+    refresh`` retrieves changed data for those variables; see :func:`.revisions`. The
+    digest is used as part of the cache key of _get_data(), so that cached data are
+    not used after the input data change.
+    """
+    parts = []
+    if source in LOCAL_DATA:
+        parts.append(fingerprint(DATA_PATH / LOCAL_DATA[source]))
+    elif source in REMOTE_DATA:
+        from .cache import revisions
+
+        parts.append(json.dumps(revisions(source, variables)))
+    if source == "SR15" or source.startswith("AR6"):
+        parts.append(fingerprint(_category_path(source)))
+    return "+".join(parts)
+
+
+#: Filters for which get_data() can use cached data for a superset of values.
+SUBSET_DIMS = ("variable", "year")
+
+
+def _get_superset(kwargs: Dict) -> pd.DataFrame:
+    """Return _get_data(**kwargs), using cached data for supersets of `kwargs`.
+
+    Each call to _get_data() is recorded in an index; see :func:`.read_subsets`. Other
+    entries with the same arguments, except :data:`SUBSET_DIMS`, and with all of the
+    requested years are used for the variables they contain; their cached data are
+    loaded and subset. Only the remaining variables, if any, are loaded by calling
+    _get_data(). The parts are combined with the union of their categories and a new
+    index, so the result equals that of _get_data(**kwargs), except for the order of
+    rows.
+
+    The `revision` argument to _get_data() is added for the variables in each call; see
+    :func:`source_revision`. Lists of filter values are sorted only for comparison
+    with the index and for the cache keys, so that equivalent calls share cached data;
+    _get_data() receives them in the order given.
+    """
+    from . import util
+    from .caching import sorted_values
+
+    def _with_revision(args):
+        revision = source_revision(args["source"], args["variable"])
+        return dict(args, revision=revision)
+
+    variables, years = kwargs["variable"], kwargs.get("year")
+    if util.SKIP_CACHE or isinstance(variables, str):
+        return _get_data(**_with_revision(kwargs))
+
+    key = json.dumps(
+        sorted_values({k: v for k, v in kwargs.items() if k not in SUBSET_DIMS}),
+        sort_keys=True,
+        default=str,
+    )
+    entry = dict(key=key, **sorted_values(dict(variable=variables, year=years)))
+    if years is not None:
+        years = set(map(int, years))
+
+    # Entries with the same key and all of `years`; most requested variables first
+    remaining = set(variables)
+    candidates = sorted(
+        filter(
+            lambda e: e["key"] == key
+            and (e["year"] is None or (years is not None and years <= set(e["year"]))),
+            util.read_subsets(_get_data),
+        ),
+        key=lambda e: (-len(remaining & set(e["variable"])), len(e["variable"])),
+    )
+
+    parts = []
+    for other in candidates:
+        covered = remaining & set(other["variable"])
+        if not covered:
+            continue
+        args = dict(kwargs, variable=other["variable"], year=other["year"])
+        if args["year"] is None:
+            args.pop("year")
+        args = _with_revision(args)
+        if not util.is_cached(_get_data, **args):
+            continue
+        elif other == entry:
+            return _get_data(**_with_revision(kwargs))  # Exact match
+
+        log.info(f"Use cached data for {len(covered)} variable(s) of {len(variables)}")
+        df = _get_data(**args)
+        if len(df):
+            mask = df["variable"].isin(covered)
+            if years is not None:
+                mask &= df["year"].isin(years)
+            parts.append(df[mask])
+        remaining -= covered
+        if not remaining:
+            break
+
+    if remaining:
+        # Load the remaining variables, and record the filters
+        entry.update(variable=sorted(remaining))
+        args = dict(kwargs, variable=[v for v in variables if v in remaining])
+        parts.append(_get_data(**_with_revision(args)))
+        util.add_subset(_get_data, entry)
+
+    parts = list(filter(len, parts)) or parts[:1]
+    if len(parts) == 1:
+        return parts[0].reset_index(drop=True)
+
+    # Combine categories, so that categorical columns are preserved by concat()
+    for name, dtype in parts[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            cat = union_categoricals([p[name] for p in parts]).categories
+            parts = [p.assign(**{name: p[name].cat.set_categories(cat)}) for p in parts]
+    return pd.concat(parts, ignore_index=True)
+
+
+@cached(unordered=True)
+def _get_data(
+    source: str = "AR6",
+    revision: str = "",
+    drop=("meta", "runId", "time"),
+    conform_to=None,
+    default_item_filters=True,
+    **filters,
+) -> pd.DataFrame:
+    """Retrieve and return data for `source`, without recategorization.
 
+    See get_data(). `revision`, from :func:`source_revision`, is used only as part of
+    the cache key.
+    """
     # Variable name replacements, if any.
     replace_var = None
 
@@ -399,10 +678,14 @@ def get_data(
             _filters = copy(filters)
             _filters["variable"] = var_name
             try:
-                dfs.append(get_data(source, conform_to=conform_to, **_filters))
+                dfs.append(
+                    _get_data(
+                        source, revision=revision, conform_to=conform_to, **_filters
+                    )
+                )
             except KeyError:
                 continue
-        return pd.concat(dfs) if len(dfs) else pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True) if len(dfs) else pd.DataFrame()
     elif "iTEM" in source:
         # Single iTEM variable: construct filters
 
@@ -433,22 +716,27 @@ def get_data(
 
     log.info(f"Get {source} data for {len(filters['variable'])} variable(s)")
 
-    if source in LOCAL_DATA:
-        # Variables for pandas melt()
-        id_vars = ["model", "scenario", "region", "variable", "unit"]
-        if "iTEM" in source:
-            # Additional columns in iTEM MIP2 and MIP3
-            id_vars.extend(["mode", "technology", "fuel"])
-        if "MIP3" in source:
-            # Additional columns in iTEM MIP3 data only
-            id_vars.extend(["service", "vehicle_type", "liquid_fuel_type"])
+    # Dimensions, i.e. columns other than "year" and "value"
+    dims = id_vars(source)
 
+    if source in LOCAL_DATA:
         # Path to data
         path = DATA_PATH / LOCAL_DATA[source]
-        result = raw_local_data(path, id_vars, path.stat().st_mtime)
+        if store.has_parquet(path):
+            # Read only the data matching `filters`
+            result = store.read_parquet(path, dims, filters)
+        elif store.has_index(path):
+            # Read only the blocks of the file containing data matching `filters`
+            result = store.read_blocks(path, dims, filters)
+        elif READ_OPTIONS["chunksize"]:
+            # Read in chunks, retaining only data matching `filters`
+            result = stream_local_data(path, dims, filters, READ_OPTIONS["chunksize"])
+        else:
+            name = path.relative_to(DATA_PATH).as_posix()
+            result = raw_local_data(name, dims, fingerprint(path))
     elif source in REMOTE_DATA:
         # Load remote data from a local cache
-        from cache import load_csv
+        from .cache import load_csv
 
         result = load_csv(source, filters)
         log.info(f"  done; {len(result)} observations.")
@@ -462,19 +750,87 @@ def get_data(
     # - Drop undesired columns,
     # - Read and apply category metadata, if any.
     return (
-        result.pipe(apply_filters, id_vars, filters)
+        result.pipe(apply_filters, dims, filters)
         .astype({"year": int})
         .pipe(item.clean_data, source, scale, replace_var)
         .dropna(subset=["value"])
         .drop(list(d for d in drop if d in result.columns), axis=1)
-        .pipe(categorize, source, recategorize=recategorize, drop_uncategorized=True)
+        .pipe(categorize, source, drop_uncategorized=True)
+        .reset_index(drop=True)
+    )
+
+
+#: Columns of the AR6 metadata file used by categorize(), and their simplified names.
+META_COLUMNS = {
+    "model": "model",
+    "scenario": "scenario",
+    # Appears in older file
+    "Temperature-in-2100_bin": "category",
+    # Appears in newer file(s) (1587047839051 and later)
+    "Category_name": "category",
+    "overshoot years|1.5°C": "os15",
+    "overshoot years|2.0°C": "os2",
+    #
+    # Appears in snapshot from 2021-06-14
+    "Vetting_historical": "vetted",
+    # Older name(s)
+    # "normal_v5_vetting_normal_v5": "vetted",
+}
+
+
+def category_data(source: str) -> pd.DataFrame:
+    """Return category metadata for `source`, indexed by (model, scenario).
+
+    The metadata file is parsed only when its contents change; the resulting table is
+    cached, keyed by the :func:`.fingerprint` of the file. The returned data frame must
+    not be modified; copy it first.
+    """
+    path = _category_path(source)
+    name = path.relative_to(DATA_PATH).as_posix()
+    return _read_category_data(name, fingerprint(path))
+
+
+def _category_path(source: str) -> Path:
+    return DATA_PATH.joinpath(
+        f"categories-{source}.csv" if source == "SR15" else LOCAL_DATA["AR6 metadata"]
+    )
+
+
+@cached
+def _read_category_data(name: str, digest: str) -> pd.DataFrame:
+    """Read the category metadata file `name`, relative to :data:`DATA_PATH`.
+
+    `digest`, a hash of the file contents, is used only as part of the cache key.
+    """
+    log.info(f"Read category metadata from {name}")
+
+    if name.endswith(".csv"):
+        return pd.read_csv(DATA_PATH / name).set_index(["model", "scenario"])
+
+    cat_data = (
+        # Read only the needed columns from file
+        pd.read_excel(
+            DATA_PATH / name,
+            sheet_name="meta",
+            usecols=lambda c: c in META_COLUMNS,
+        )
+        # Simplify column names
+        .rename(columns=META_COLUMNS).set_index(["model", "scenario"])
     )
 
+    if cat_data.index.has_duplicates:
+        dupe = cat_data.index.duplicated()
+        log.info(f"Drop {dupe.sum()} duplicated (model, scenario) from metadata")
+        cat_data = cat_data[~dupe]
+
+    return cat_data
+
 
 def categorize(df, source, **options):
     """Modify `df` from `source` to add 'category' columns.
 
-    This involved merging the contents of `df` with appropriate metadata.
+    This involved merging the contents of `df` with appropriate metadata; see
+    category_data().
 
     `options` include:
 
@@ -482,87 +838,66 @@ def categorize(df, source, **options):
       attribute contains the string "FAIL"; retain all others. NB this column name has
       varied, so the code below maps the varying name to "vetted". This gives the same
       result as excluding scenarios for which the "exclude" attribute is "True".
-    - ``recategorize``: either "A" or "B". Values from :data:`CAT_GROUP` are used to
-      recategorize, i.e. by merging together categories from the base data.
+    - ``recategorize``: either "A" or "B"; see regroup_categories().
     """
     if source in ("SR15",):
-        # Read a CSV file
-        cat_data = pd.read_csv(DATA_PATH / f"categories-{source}.csv")
+        # Category data from a CSV file
+        cat_data = category_data(source).reset_index()
         result = df.merge(cat_data, how="left", on=["model", "scenario"])
 
     elif source.startswith("AR6"):
-        # Load category data for IAMs from a file
-        cat_data = (
-            # Read from file
-            pd.read_excel(DATA_PATH / LOCAL_DATA["AR6 metadata"], sheet_name="meta")
-            # Simplify column names
-            .rename(
-                columns={
-                    # Appears in older file
-                    "Temperature-in-2100_bin": "category",
-                    # Appears in newer file(s) (1587047839051 and later)
-                    "Category_name": "category",
-                    "overshoot years|1.5°C": "os15",
-                    "overshoot years|2.0°C": "os2",
-                    #
-                    # Appears in snapshot from 2021-06-14
-                    "Vetting_historical": "vetted",
-                    # Older name(s)
-                    # "normal_v5_vetting_normal_v5": "vetted",
-                }
-            ).set_index(["model", "scenario"])
+        # Category data for IAMs from a file, and for national and sectoral scenario
+        # data in the database. Entries from the latter replace any from the former.
+        extra = pd.DataFrame(
+            [
+                dict(model=i["model"], scenario=i["scenario"], category=i["category"])
+                for i in chain(SCENARIOS["national"], SCENARIOS["sectoral"])
+            ]
+        ).set_index(["model", "scenario"])
+        cat_data = pd.concat(
+            [category_data(source)[["category", "vetted"]], extra.assign(vetted="N/A")]
         )
+        cat_data = cat_data[~cat_data.index.duplicated(keep="last")]
 
-        if cat_data.index.has_duplicates:
-            dupe = cat_data.index.duplicated()
-            log.info(f"Drop {dupe.sum()} duplicated (model, scenario) from metadata")
-            cat_data = cat_data[~dupe]
-
-        # Add categories for national and sectoral scenario data in the database
-        for info in chain(SCENARIOS["national"], SCENARIOS["sectoral"]):
-            key = (info["model"], info["scenario"])
-            cat_data.loc[key, :] = pd.Series(
-                dict(category=info["category"], vetted="N/A")
-            )
-
-        # Merge the metadata columns with the data
-        result = df.merge(
-            cat_data[["category", "vetted"]],
-            how="left",
-            left_on=["model", "scenario"],
-            right_index=True,
-        )
+        # Metadata for each distinct (model, scenario)
+        codes, pairs = _scenario_keys(df)
+        meta = cat_data.reindex(pairs)
 
         if options.get("vetted_only", True):
             # Drop all but vetted scenarios
-            N = len(result)
-            result = result.query("vetted != 'FAIL'")
+            keep = (meta["vetted"] != "FAIL").to_numpy()[codes]
             log.info(
-                f"Drop {N - len(result)} / {N} obs from scenarios that failed vetting"
+                f"Drop {len(df) - keep.sum()} / {len(df)} obs from scenarios that "
+                "failed vetting"
             )
+            df, codes = df[keep], codes[keep]
 
         recategorize = options.get("recategorize")
         if recategorize:
-            # Mapping from original categories to new
-            cg = CAT_GROUP[recategorize]
-
-            log.info(f"Recategorize scenarios using scheme {repr(recategorize)}")
+            meta = regroup_categories(meta, recategorize)
 
-            # Split 'category' column on ":", look up the first part in `cg`
-            result = result.assign(
-                category=result["category"].str.split(":", expand=True)[0].replace(cg)
-            )
+        # Add the metadata columns to the data
+        result = df.assign(
+            **{name: meta[name].to_numpy()[codes] for name in ("category", "vetted")}
+        )
 
     elif source.startswith("iTEM"):
         # From the iTEM database metadata
 
         # Version of the iTEM database, e.g. 2 for MIP2
         mip_number = int(source[-1])
-        result = df.assign(
-            category=df.apply(item.cat_for_scen, axis=1, args=(mip_number,)).replace(
-                "policy-extra", "policy"
-            )
-        )
+
+        # Look up each distinct (model, scenario) in an index of categories for the
+        # models
+        cat_data = item.categories(df["model"].unique(), mip_number)
+        codes, pairs = _scenario_keys(df)
+        indexer = cat_data.index.get_indexer(pairs)
+        if (indexer == -1).any():
+            missing = pairs[indexer == -1].to_frame(index=False)
+            raise KeyError(f"No iTEM category for:\n{missing.to_string(index=False)}")
+
+        category = cat_data.iloc[indexer].replace("policy-extra", "policy")
+        result = df.assign(category=category.to_numpy()[codes])
 
     elif source == "IMO":
         result = df.assign(category="IMO")
@@ -576,6 +911,38 @@ def categorize(df, source, **options):
     return result
 
 
+def regroup_categories(df: pd.DataFrame, scheme: str) -> pd.DataFrame:
+    """Recategorize `df` using `scheme`, either "A" or "B".
+
+    Values from :data:`CAT_GROUP` are used to recategorize, i.e. by merging together
+    categories from the base data: the "category" of each row is split on ":", and the
+    first part looked up in the mapping. Each distinct category is looked up only once.
+    """
+    # Mapping from original categories to new
+    cg = CAT_GROUP[scheme]
+
+    log.info(f"Recategorize scenarios using scheme {repr(scheme)}")
+
+    categories = df["category"].dropna().unique()
+    first = [c.split(":")[0] for c in categories]
+    mapping = dict(zip(categories, [cg.get(f, f) for f in first]))
+    return df.assign(category=df["category"].map(mapping))
+
+
+def _scenario_keys(df: pd.DataFrame) -> Tuple[np.ndarray, pd.MultiIndex]:
+    """Return an integer key for the (model, scenario) of each row in `df`.
+
+    Returns
+    -------
+    numpy.ndarray
+        For each row, the position of its (model, scenario) in the second return value.
+    pandas.MultiIndex
+        Distinct (model, scenario) in `df`, in order of first appearance.
+    """
+    groups = df.groupby(["model", "scenario"], sort=False, observed=True, dropna=False)
+    return groups.ngroup().to_numpy(), groups.size().index
+
+
 def split_scenarios(df: pd.DataFrame, groups=[]):
     """Split `df` into two data frames using `groups`.
 
@@ -1,10 +1,126 @@
 """Minimal clients for the IIASA Scenario Explorer APIs."""
+import codecs
 import json
+import re
 from abc import ABC, abstractmethod
+from threading import Lock
+from time import monotonic, sleep
+from typing import Dict, Iterator
+from urllib.parse import urlparse
 
 import requests
-
-from .common import CONFIG, REMOTE_DATA
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .common import CONFIG, REMOTE_DATA, REMOTE_OPTIONS
+
+
+class RateLimit:
+    """Limit requests to at most `rate` per second, across threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = Lock()
+        self._next = 0.0
+
+    def wait(self):
+        """Block until the next request is allowed."""
+        with self._lock:
+            now = monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+#: RateLimit for each host.
+_limits: Dict[str, RateLimit] = {}
+_limits_lock = Lock()
+
+
+def rate_limit(url: str) -> RateLimit:
+    """Return the RateLimit for the host of `url`."""
+    host = urlparse(url).netloc
+    with _limits_lock:
+        if host not in _limits:
+            _limits[host] = RateLimit(REMOTE_OPTIONS["rate"])
+        return _limits[host]
+
+
+#: Whitespace and separators between elements of a JSON array.
+_SEPARATOR = re.compile(r"[\s,]*")
+
+#: End of a complete element of a JSON array.
+_END = re.compile(r"\s*[,\]]")
+
+
+def iter_json_array(response: requests.Response, chunk_size=2 ** 16) -> Iterator:
+    """Yield the elements of the JSON array in the body of `response`.
+
+    Elements are parsed as the body arrives, so only one element at a time, rather than
+    the entire array, is held in memory. `response` should be from a request with
+    ``stream=True``.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = None  # Position in `buffer`; None before the opening "["
+
+    for chunk in response.iter_content(chunk_size):
+        buffer += text.decode(chunk)
+        if pos is None:
+            start = buffer.lstrip()
+            if not start:
+                continue
+            elif not start.startswith("["):
+                raise ValueError(f"Expected a JSON array; got {start[:20]!r}")
+            buffer, pos = start, 1
+
+        while True:
+            pos = _SEPARATOR.match(buffer, pos).end()
+            if buffer.startswith("]", pos):
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # Incomplete element; read more
+            if not _END.match(buffer, end):
+                # The element may continue in the next chunk, e.g. a number split
+                # across chunks; in a complete array it is followed by "," or "]"
+                break
+            pos = end
+            yield element
+
+        # Discard parsed content
+        buffer, pos = buffer[pos:], 0
+
+    raise ValueError("Incomplete JSON array in response")
+
+
+def make_session() -> requests.Session:
+    """Return a session with pooled, keep-alive connections and automatic retries.
+
+    Failed requests, including those with responses indicating server errors or
+    throttling, are retried with exponential backoff; see :data:`.REMOTE_OPTIONS`.
+    Responses are transferred with gzip compression when the server supports it.
+    """
+    retry = Retry(
+        total=REMOTE_OPTIONS["retries"],
+        backoff_factor=REMOTE_OPTIONS["backoff"],
+        status_forcelist=[429, 500, 502, 503, 504],
+        # POST is used for idempotent queries, so may also be retried
+        allowed_methods=None,
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=REMOTE_OPTIONS["jobs"], max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
 
 
 class BaseClient(ABC):
@@ -12,6 +128,14 @@ class BaseClient(ABC):
 
     base_url = None
     _token = None
+    _session = None
+
+    @property
+    def session(self) -> requests.Session:
+        """Session used for all requests; see :func:`make_session`."""
+        if self._session is None:
+            self._session = make_session()
+        return self._session
 
     def url(self, *parts):
         """Return a URL under base_url by combining *parts*."""
@@ -29,38 +153,41 @@ class BaseClient(ABC):
     def with_token(self, headers={}):
         """Modify *headers* to include the token."""
         self.set_token()
+        headers = headers.copy()
         headers["Authorization"] = f"Bearer {self._token}"
         return headers
 
-    def get(self, *endpoint, params={}, headers={}):
-        """Execute a GET request against *endpoint*, with auth."""
-        response = requests.get(
-            url=self.url(*endpoint),
-            params=params,
-            headers=self.with_token(headers),
+    def request(self, method, url, **kwargs) -> requests.Response:
+        """Execute a request, subject to the rate limit for the host of `url`."""
+        rate_limit(url).wait()
+        response = self.session.request(
+            method, url, timeout=REMOTE_OPTIONS["timeout"], **kwargs
         )
         response.raise_for_status()
-        return response.json()
+        return response
+
+    def get(self, *endpoint, params={}, headers={}):
+        """Execute a GET request against *endpoint*, with auth."""
+        return self.request(
+            "GET", self.url(*endpoint), params=params, headers=self.with_token(headers)
+        ).json()
 
     def post(self, *endpoint, data=None, params={}, headers={}):
         """Execute a POST request against *endpoint*, with auth."""
-        response = requests.post(
-            url=self.url(*endpoint),
+        return self.request(
+            "POST",
+            self.url(*endpoint),
             data=data,
             params=params,
             headers=self.with_token(headers),
-        )
-        response.raise_for_status()
-        return response.json()
+        ).json()
 
 
 class AuthClient(BaseClient):
     """Client for the SE authentication API."""
 
-    # Fixed base_url
-    base_url = "https://db1.ene.iiasa.ac.at/EneAuth/config/v1"
-
-    def __init__(self, **credentials):
+    def __init__(self, base_url=None, **credentials):
+        self.base_url = base_url or REMOTE_OPTIONS["auth_url"]
         self.credentials = credentials
 
     def set_token(self):
@@ -68,13 +195,12 @@ class AuthClient(BaseClient):
         if self._token is not None:
             return
 
-        r = requests.post(
+        self._token = self.request(
+            "POST",
             self.url("login"),
             headers={"Content-Type": "application/json"},
             data=json.dumps(self.credentials),
-        )
-        r.raise_for_status()
-        self._token = r.json()
+        ).json()
 
     # Particular endpoints
     def applications(self):
@@ -89,16 +215,19 @@ class AuthClient(BaseClient):
     def get_app(self, name):
         """Return a client for a particular application **name**."""
         app_config = {entry["path"]: entry["value"] for entry in self.app_config(name)}
-        return AppClient(app_config["baseUrl"], app_config, self._token)
+        return AppClient(
+            app_config["baseUrl"], app_config, self._token, session=self.session
+        )
 
 
 class AppClient(BaseClient):
     """Client for the SE application API."""
 
-    def __init__(self, base_url, app_config, token):
+    def __init__(self, base_url, app_config, token, session=None):
         self.base_url = base_url
         self.config = app_config
         self._token = token
+        self._session = session
 
     def set_token(self, value=None):
         # Do nothing; use the token passed to the constructor
@@ -112,17 +241,24 @@ class AppClient(BaseClient):
             params={"getOnlyDefaultRuns": str(get_only_default_runs).lower()},
         )
 
-    def runs_bulk_ts(self, **filters):
-        """Bulk timeseries data."""
+    def runs_bulk_ts(self, stream=False, **filters):
+        """Bulk timeseries data.
+
+        If `stream` is :obj:`True`, return an iterator over the records, parsed as the
+        response arrives; see :func:`iter_json_array`. Otherwise, return a list.
+        """
         # NB the API returns 500 errors if any of these are not set
         for key in "regions", "runs", "times", "units", "variables", "years":
             filters.setdefault(key, [])
 
-        return self.post(
-            "runs/bulk/ts",
+        response = self.request(
+            "POST",
+            self.url("runs/bulk/ts"),
             data=json.dumps(dict(filters=filters)),
-            headers={"Content-Type": "application/json"},
+            headers=self.with_token({"Content-Type": "application/json"}),
+            stream=stream,
         )
+        return iter_json_array(response) if stream else response.json()
 
     def variables(self, run_id, filters=[]):
         return self.get(f"runs/{run_id}/vars", params={"filters": "[]"})
@@ -0,0 +1,286 @@
+"""Local stand-in for the IIASA Scenario Explorer APIs.
+
+The server implements the endpoints used by the clients in iiasa_se_client.py, with
+synthetic data, so that remote retrieval can be tested and benchmarked without network
+access or credentials. Start it with serve(), then point the clients at it using the
+``auth_url`` key of :data:`.REMOTE_OPTIONS`, or the ``--url`` option of the ``remote``
+command.
+
+Responses to bulk timeseries queries are generated and sent in chunks, optionally with
+gzip compression, as from the real server. Latency, server errors, and throttling can
+be injected to test the retries and rate limits of the clients; see bench-remote.
+"""
+import json
+import logging
+import multiprocessing
+import random
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, Iterator, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger(__name__)
+
+#: Size of chunks in streamed responses.
+CHUNK_SIZE = 2 ** 16
+
+#: Date format used by the Scenario Explorer; see :data:`.DATE_FORMAT`.
+DATE = "2021-01-01 00:00:00.000000"
+
+
+class Server(ThreadingHTTPServer):
+    """Server with synthetic data for `runs` runs.
+
+    Each run has data for `variables` variables and `regions` regions in each of
+    `years`.
+
+    Parameters
+    ----------
+    latency : float
+        Delay, in seconds, before responding to each request to the application API.
+    error_rate : float
+        Fraction of requests to the application API that fail with HTTP status 500.
+    throttle : float
+        If given, requests to the application API beyond this number per second fail
+        with HTTP status 429 and a Retry-After header.
+    seed : int
+        Seed for random errors.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        runs: int = 10,
+        variables: int = 50,
+        regions: int = 10,
+        years: List[int] = list(range(2005, 2101, 5)),
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        throttle: float = None,
+        seed: int = 0,
+    ):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self._random = random.Random(seed)
+        self._recent: deque = deque()
+        self._lock = Lock()
+
+        #: Counts of requests to the application API, injected errors, and bytes sent.
+        self.stats = dict(requests=0, errors=0, throttled=0, bytes=0)
+
+        self.runs = [
+            dict(
+                run_id=i,
+                model=f"Model {i % 7}",
+                scenario=f"Scenario {i}",
+                version=1,
+                is_default=True,
+                cre_date=DATE,
+                upd_date=None,
+            )
+            for i in range(1, runs + 1)
+        ]
+        self.variables = [f"Variable|{i}" for i in range(variables)]
+        self.regions = ["World"] + [f"R{i}" for i in range(1, regions)]
+        self.years = years
+
+    def handle_error(self, request, client_address):
+        # Clients may close connections, e.g. after an error response; don't print
+        log.debug(f"Error handling request from {client_address}", exc_info=True)
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    @property
+    def auth_url(self) -> str:
+        """Base URL for the authentication API."""
+        return f"{self.url}/auth"
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def fault(self) -> int:
+        """Apply latency; return an HTTP status for an injected error, or 0 for none."""
+        sleep(self.latency)
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.throttle:
+                # Requests in the last second
+                now = monotonic()
+                while self._recent and self._recent[0] < now - 1:
+                    self._recent.popleft()
+                if len(self._recent) >= self.throttle:
+                    self.stats["throttled"] += 1
+                    return 429
+                self._recent.append(now)
+            if self._random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return 500
+        return 0
+
+    def records(self, run_ids: List[int]) -> Iterator[Dict]:
+        """Generate timeseries records for `run_ids`, default all runs."""
+        runs = {r["run_id"]: r for r in self.runs}
+        for run_id in run_ids or runs:
+            run = runs[run_id]
+            for (v, variable), region, year in product(
+                enumerate(self.variables), self.regions, self.years
+            ):
+                yield dict(
+                    model=run["model"],
+                    scenario=run["scenario"],
+                    variable=variable,
+                    region=region,
+                    unit="EJ/yr",
+                    year=year,
+                    value=run_id + v + (year - 2000) / 100,
+                    runId=run_id,
+                    version=run["version"],
+                    time=0,
+                    meta=0,
+                )
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Handle requests to :class:`Server`."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def _send(self, obj, status=200, headers={}):
+        """Send `obj` as JSON."""
+        self._send_chunks([json.dumps(obj)], status, headers)
+
+    def _send_chunks(self, chunks, status=200, headers={}):
+        """Send text `chunks` with chunked transfer encoding and optional gzip."""
+        gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        compressor = zlib.compressobj(wbits=31) if gzip else None
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        if gzip:
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def _write(data: bytes):
+            if data:
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.server.count("bytes", len(data))
+
+        for chunk in chunks:
+            data = chunk.encode()
+            _write(compressor.compress(data) if gzip else data)
+        if gzip:
+            _write(compressor.flush())
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _fault(self) -> bool:
+        """Inject latency or errors; return :obj:`True` if an error was sent."""
+        status = self.server.fault()
+        if status == 429:
+            self._send(dict(error="Too many requests"), 429, {"Retry-After": "1"})
+        elif status:
+            self._send(dict(error="Internal server error"), status)
+        return bool(status)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+
+        if parts[0] == "auth" and parts[1:2] == ["applications"]:
+            # Configuration of an application; point it to this server
+            self._send([dict(path="baseUrl", value=f"{self.server.url}/app")])
+        elif parts == ["stats"]:
+            self._send(self.server.stats)
+        elif parts[0] != "app":
+            self._send(dict(error="Not found"), 404)
+        elif self._fault():
+            pass  # Error response already sent
+        elif parts[1:] == ["runs"]:
+            default = parse_qs(url.query).get("getOnlyDefaultRuns") == ["true"]
+            self._send([r for r in self.server.runs if r["is_default"] or not default])
+        elif parts[1:2] == ["runs"] and parts[3:] == ["vars"]:
+            self._send([dict(name=v) for v in self.server.variables])
+        else:
+            self._send(dict(error="Not found"), 404)
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        body = self._body()
+
+        if parts == ["auth", "login"]:
+            self._send("token")
+        elif parts == ["app", "runs", "bulk", "ts"]:
+            if not self._fault():
+                runs = body["filters"].get("runs", [])
+                self._send_chunks(self._stream(self.server.records(runs)))
+        else:
+            self._send(dict(error="Not found"), 404)
+
+    @staticmethod
+    def _stream(records: Iterator[Dict]) -> Iterator[str]:
+        """Encode `records` as a JSON array, in chunks of about :data:`CHUNK_SIZE`."""
+        buffer = ["["]
+        size = 1
+        for i, record in enumerate(records):
+            text = ("," if i else "") + json.dumps(record)
+            buffer.append(text)
+            size += len(text)
+            if size >= CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        buffer.append("]")
+        yield "".join(buffer)
+
+
+def serve(**kwargs) -> Server:
+    """Start a :class:`Server` in a background thread and return it.
+
+    `kwargs` are passed to :class:`Server`. Stop the server with
+    :meth:`~.Server.shutdown`.
+    """
+    server = Server(**kwargs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Serving {len(server.runs)} runs at {server.url}")
+    return server
+
+
+def _serve_forever(kwargs, connection):
+    server = Server(**kwargs)
+    connection.send(server.url)
+    server.serve_forever()
+
+
+def serve_process(**kwargs) -> Tuple[str, multiprocessing.Process]:
+    """Start a :class:`Server` in a separate process; return its URL and the process.
+
+    Unlike :func:`serve`, the server and the clients do not compete for the GIL, so
+    this is suitable for benchmarks. The :attr:`~.Server.stats` are available from
+    the ``/stats`` endpoint. Stop the server with :meth:`~.Process.terminate`.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve_forever, args=(kwargs, child), daemon=True
+    )
+    process.start()
+    url = parent.recv()
+    log.info(f"Serving at {url}")
+    return url, process
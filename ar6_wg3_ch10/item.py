@@ -1,7 +1,7 @@
 """Compatibility for the iTEM databases."""
 import logging
 from functools import lru_cache
-from typing import Dict, Tuple
+from typing import Dict, Iterable, Tuple
 
 import item.model
 import pandas as pd
@@ -11,9 +11,23 @@ from .common import VARIABLES
 log = logging.getLogger(__name__)
 
 
-def cat_for_scen(row: pd.Series, mip: str):
-    """Return the iTEM scenario category for model & scenario info."""
-    return scen_info(row["model"], mip)[row["scenario"]]["category"]
+def categories(models: Iterable[str], mip: int) -> pd.Series:
+    """Return iTEM scenario categories for `models`, indexed by (model, scenario)."""
+    return pd.concat(
+        [_categories(name, mip) for name in sorted(set(models))]
+        or [pd.Series([], index=pd.MultiIndex.from_tuples([], names=[None] * 2))]
+    )
+
+
+@lru_cache()
+def _categories(name: str, mip: int) -> pd.Series:
+    """Return iTEM scenario categories for model `name`; see scen_info()."""
+    info = scen_info(name, mip)
+    return pd.Series(
+        [i["category"] for i in info.values()],
+        index=pd.MultiIndex.from_product([[name], info.keys()]),
+        dtype=object,
+    )
 
 
 def clean_data(
@@ -0,0 +1,317 @@
+"""Alternative storage layouts for local data files.
+
+The snapshot files in LOCAL_DATA are large, gzipped CSV files in ‘wide’ format. Reading
+one in full, only to discard most of it in apply_filters(), dominates the time and
+memory used by get_data(). The functions here convert the files to layouts from which
+only the subset of data matching the filters need be read:
+
+- write_parquet() creates a Parquet dataset alongside the original file.
+- write_blocks() rewrites the file in place, with a small sidecar index. This needs no
+  additional disk space.
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+#: Size of blocks read from CSV files during conversion.
+BLOCK_SIZE = 64 * 2 ** 20
+
+#: Maximum number of rows in each gzip member written by write_blocks().
+BLOCK_ROWS = 10000
+
+#: Number of rows read at once by write_blocks().
+CHUNK_ROWS = 100000
+
+
+def _stat(path: Path) -> Dict:
+    """Return information used to check whether a derived file is up to date."""
+    stat = path.stat()
+    return dict(mtime=stat.st_mtime, size=stat.st_size)
+
+
+def _is_year(name: str) -> bool:
+    return name.isdigit()
+
+
+def partitioning():
+    """Return the partitioning of Parquet datasets: by "variable", in Hive style."""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([("variable", pa.string())]), flavor="hive")
+
+
+def filter_expression(filters: Dict, names: List[str]) -> Optional[object]:
+    """Return an expression for data matching `filters`, or :obj:`None` for all data.
+
+    Only filters on columns in `names` are included. Values for "year" are converted to
+    integers.
+    """
+    import pyarrow.dataset as ds
+
+    expr = None
+    for dim, values in filters.items():
+        if dim not in names:
+            continue
+        values = [values] if isinstance(values, (str, int)) else list(values)
+        if dim == "year":
+            values = list(map(int, values))
+        condition = ds.field(dim).isin(values)
+        expr = condition if expr is None else expr & condition
+    return expr
+
+
+def parquet_path(path: Path) -> Path:
+    """Return the path of the Parquet dataset for the CSV file at `path`."""
+    return path.with_name(path.name.split(".")[0] + ".parquet")
+
+
+def has_parquet(path: Path) -> bool:
+    """Return :obj:`True` if an up-to-date Parquet dataset exists for `path`."""
+    try:
+        info = json.loads(parquet_path(path).joinpath("_source.json").read_text())
+    except FileNotFoundError:
+        return False
+    return info == _stat(path)
+
+
+def write_parquet(path: Path, dims: List[str]) -> Path:
+    """Convert the CSV file at `path` to a Parquet dataset partitioned by "variable".
+
+    Column names matching `dims` except for case are renamed to lower case, as in
+    raw_local_data(). Columns with names like years are stored as floats; all others as
+    strings. The file is read in blocks of :data:`BLOCK_SIZE`, so the memory used does
+    not depend on the size of `path`.
+
+    The partition for each variable is then sorted by region and written in row groups
+    of at most :data:`BLOCK_ROWS` rows, so that each row group spans few regions and
+    filters on "region" skip most of them; this uses memory for the data for one
+    variable. The dataset is written to a temporary directory, then replaces any
+    existing dataset, so that partitions for variables no longer in `path` are removed.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    target = parquet_path(path)
+    tmp = target.with_name(target.name + ".part")
+    log.info(f"Convert {path} to {target}")
+
+    # Peek at column names
+    columns = pd.read_csv(path, nrows=0).columns
+    names = [(c.lower() if c.lower() in dims else c) for c in columns]
+    schema = pa.schema(
+        [(n, pa.float64() if _is_year(n) else pa.string()) for n in names]
+    )
+
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={c: schema.field(n).type for c, n in zip(columns, names)}
+        ),
+    )
+
+    # Write the data, applying the new column names to each batch
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.write_dataset(
+        (pa.RecordBatch.from_arrays(b.columns, schema=schema) for b in reader),
+        tmp,
+        schema=schema,
+        format="parquet",
+        partitioning=partitioning(),
+        max_partitions=2 ** 16,
+    )
+
+    if "region" in names:
+        # Sort the data for each variable by region
+        for file in tmp.glob("*/*.parquet"):
+            table = pq.ParquetFile(file).read().sort_by("region")
+            pq.write_table(table, file, row_group_size=BLOCK_ROWS)
+
+    # Record the state of the source file; see has_parquet()
+    tmp.joinpath("_source.json").write_text(json.dumps(_stat(path)))
+
+    # Replace any existing dataset
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+
+    return target
+
+
+def read_parquet(path: Path, dims: List[str], filters: Dict) -> pd.DataFrame:
+    """Read data matching `filters` from the Parquet dataset for `path`.
+
+    Filters on any of `dims` are pushed down into the read, so that only partitions
+    (for "variable") and row groups containing matching data are decoded. Only the
+    columns for the "year" filter, if any, are read.
+
+    The returned data frame is in ‘wide’ format, like that from raw_local_data().
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        parquet_path(path), format="parquet", partitioning=partitioning()
+    )
+
+    # Construct an expression for the filters on dimensions
+    expr = filter_expression(
+        filters, [n for n in dataset.schema.names if n in dims]
+    )
+
+    # Columns to read: dims and any columns matching the "year" filter
+    years = set(map(str, filters.get("year", [])))
+    columns = list(
+        filter(
+            lambda c: not _is_year(c) or not years or c in years, dataset.schema.names
+        )
+    )
+
+    df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+    log.info(f"Read {len(df)} rows from {parquet_path(path).name}")
+
+    return df.astype({d: "category" for d in dims if d in df.columns})
+
+
+def index_path(path: Path) -> Path:
+    """Return the path of the sidecar index for the block-gzip file at `path`."""
+    return path.with_name(path.name + ".idx")
+
+
+def has_index(path: Path) -> bool:
+    """Return :obj:`True` if an up-to-date sidecar index exists for `path`."""
+    try:
+        return _load_index(index_path(path), **_stat(path)) is not None
+    except FileNotFoundError:
+        return False
+
+
+@lru_cache()
+def _load_index(path: Path, mtime: float, size: int):
+    """Load the index at `path`; return :obj:`None` if it does not match the file."""
+    info = json.loads(path.read_text())
+    return info if (info["mtime"], info["size"]) == (mtime, size) else None
+
+
+def write_blocks(path: Path, dims: List[str], rows: int = BLOCK_ROWS) -> Path:
+    """Rewrite the CSV file at `path` as block-gzip and write a sidecar index.
+
+    The rows of `path` are sorted by variable and region, then written in blocks of at
+    most `rows` rows. Each block is a separate gzip member, so the rewritten file is
+    still a valid .csv.gz file that can be read by any other code. The index records
+    the byte range, variable, and regions of each block; see read_blocks().
+
+    The file is replaced atomically, and values are copied as text, i.e. without loss.
+    It is read in chunks of :data:`CHUNK_ROWS` rows, and the rows for each variable are
+    spilled to a temporary, uncompressed file in the same directory, so the memory used
+    depends on the size of the data for one variable, not of `path`.
+    """
+    log.info(f"Rewrite {path} as block-gzip")
+
+    # Options to read all values as text, without conversion
+    read_args = dict(dtype=str, keep_default_na=False)
+
+    columns = pd.read_csv(path, nrows=0).columns
+    col = {c.lower(): c for c in columns if c.lower() in dims}
+
+    blocks = []
+    tmp = path.with_name(path.name + ".tmp")
+    with TemporaryDirectory(dir=path.parent) as spill_dir, open(tmp, "wb") as f:
+        # - Spill the rows for each variable, in order, to a separate file.
+        # - Sort by variable, then by region, keeping the order of rows otherwise.
+        spill: Dict[str, Path] = {}
+        with pd.read_csv(path, chunksize=CHUNK_ROWS, **read_args) as reader:
+            for chunk in reader:
+                for variable, group_df in chunk.groupby(col["variable"], sort=False):
+                    name = spill.setdefault(
+                        variable, Path(spill_dir, f"{len(spill)}.csv")
+                    )
+                    group_df.to_csv(name, mode="a", header=False, index=False)
+
+        # Header in its own member, written like the rows
+        text = pd.DataFrame(columns=columns).to_csv(index=False)
+        f.write(gzip.compress(text.encode()))
+        header = [0, f.tell()]
+
+        for variable in sorted(spill):
+            group_df = pd.read_csv(
+                spill[variable], header=None, names=columns, **read_args
+            ).sort_values(col["region"], kind="stable")
+            for start in range(0, len(group_df), rows):
+                block = group_df.iloc[slice(start, start + rows)]
+                offset = f.tell()
+                f.write(gzip.compress(block.to_csv(header=False, index=False).encode()))
+                blocks.append(
+                    dict(
+                        variable=variable,
+                        region=sorted(block[col["region"]].unique()),
+                        range=[offset, f.tell() - offset],
+                    )
+                )
+            spill[variable].unlink()
+
+    os.replace(tmp, path)
+
+    # Write the index, keyed on the state of the rewritten file
+    target = index_path(path)
+    target.write_text(json.dumps(dict(header=header, blocks=blocks, **_stat(path))))
+    log.info(f"Wrote {len(blocks)} blocks; index in {target}")
+
+    return target
+
+
+def read_blocks(path: Path, dims: List[str], filters: Dict) -> pd.DataFrame:
+    """Read data matching `filters` from the block-gzip file at `path`.
+
+    Only the blocks that contain the variables and regions in `filters`, according to
+    the index written by write_blocks(), are decompressed and parsed. Only the columns
+    for the "year" filter, if any, are parsed.
+
+    The returned data frame is in ‘wide’ format, like that from raw_local_data().
+    """
+    info = _load_index(index_path(path), **_stat(path))
+
+    # Sets of values for filtered dimensions
+    sets = {
+        dim: {filters[dim]} if isinstance(filters[dim], str) else set(filters[dim])
+        for dim in ("variable", "region")
+        if dim in filters
+    }
+
+    def _select(block):
+        return (
+            "variable" not in sets or block["variable"] in sets["variable"]
+        ) and ("region" not in sets or sets["region"] & set(block["region"]))
+
+    blocks = list(filter(_select, info["blocks"]))
+    log.info(f"Read {len(blocks)} of {len(info['blocks'])} blocks from {path.name}")
+
+    # Decompress the header and selected blocks
+    buffer = BytesIO()
+    with open(path, "rb") as f:
+        for offset, length in [info["header"]] + [b["range"] for b in blocks]:
+            f.seek(offset)
+            buffer.write(gzip.decompress(f.read(length)))
+    buffer.seek(0)
+
+    # Columns to parse: dims and any columns matching the "year" filter
+    years = set(map(str, filters.get("year", [])))
+
+    def _usecols(name):
+        return not _is_year(name) or not years or name in years
+
+    df = pd.read_csv(buffer, usecols=_usecols)
+    rename = {c: c.lower() for c in df.columns if c.lower() in dims}
+    return df.rename(columns=rename).astype({d: "category" for d in rename.values()})
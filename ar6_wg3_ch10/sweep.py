@@ -0,0 +1,204 @@
+"""Generate many variants of plots, optionally in parallel."""
+import logging
+import logging.config
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
+from importlib import import_module
+from time import perf_counter
+from traceback import format_exc
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+#: A figure ID and options for the figure class.
+Variant = Tuple[int, Dict]
+
+
+def figure_class(fig_id: int):
+    """Return the class for figure `fig_id`."""
+    mod = import_module(f".fig_{fig_id}", package="ar6_wg3_ch10")
+    return getattr(mod, f"Fig{fig_id}")
+
+
+def plot_one(fig_id: int, options: Dict, data: Dict = None) -> None:
+    """Generate figure `fig_id` with `options` and save to file.
+
+    If `data` is given, it is used instead of loading data; see Figure.load_data().
+    """
+    # Figure.__init__() modifies its argument; give a copy
+    figure_class(fig_id)(options.copy()).save(data)
+
+
+def plan(variants: List[Variant]) -> List[List[Variant]]:
+    """Group `variants` that use the same input data.
+
+    Variants are grouped by Figure.load_key(). Groups are returned in order of their
+    first variant; within each group, the order of `variants` is kept.
+    """
+    groups: Dict[tuple, List[Variant]] = {}
+    for fig_id, options in variants:
+        key = figure_class(fig_id).load_key(options)
+        groups.setdefault(key, []).append((fig_id, options))
+    return list(groups.values())
+
+
+def label(variant: Variant) -> str:
+    """Return a short, human-readable label for `variant`."""
+    fig_id, options = variant
+    return " ".join(
+        filter(
+            None,
+            [
+                f"fig{fig_id}",
+                options["sources"][0],
+                None if options.get("normalize", True) else "abs",
+                "percap" if options.get("per_capita") else None,
+                f"recat{options['recategorize']}"
+                if options.get("recategorize")
+                else None,
+                f"bw{options['bandwidth']}" if options.get("bandwidth") else None,
+            ],
+        )
+    )
+
+
+def _init(settings: Dict) -> None:
+    """Apply `settings` from the parent process in a worker process."""
+    from . import util
+    from .common import CACHE_OPTIONS, READ_OPTIONS
+
+    logging.config.dictConfig(settings["log"])
+    READ_OPTIONS.update(settings["read"])
+    CACHE_OPTIONS.update(settings["cache"])
+    util.SKIP_CACHE = settings["skip_cache"]
+
+
+def _result(variant: Variant, start: float, error: str = None) -> Dict:
+    return dict(
+        variant=label(variant),
+        status="ok" if error is None else "FAIL",
+        seconds=round(perf_counter() - start, 1),
+        error=error,
+    )
+
+
+def _run(group: List[Variant]) -> List[Dict]:
+    """Generate a `group` of variants; return statuses, durations, and tracebacks.
+
+    Data are loaded once for the group. If this fails, every variant in the group fails.
+    """
+    start = perf_counter()
+    try:
+        fig_id, options = group[0]
+        data = figure_class(fig_id)(options.copy()).load_data()
+    except Exception:
+        error = format_exc()
+        return [_result(variant, start, error) for variant in group]
+
+    results = []
+    for variant in group:
+        start = perf_counter()
+        try:
+            plot_one(*variant, data=data)
+        except Exception:
+            results.append(_result(variant, start, format_exc()))
+        else:
+            results.append(_result(variant, start))
+
+    return results
+
+
+def run(variants: List[Variant], jobs: int = 1, log_config: Dict = None) -> List[Dict]:
+    """Generate all `variants`; print a summary table.
+
+    Variants that use the same input data are grouped by plan(); data for each group
+    are loaded once, and each variant receives its own copy.
+
+    With `jobs` greater than 1, groups are generated in a pool of that many worker
+    processes. With Python 3.11 or later, each worker process generates exactly one
+    group, so groups are isolated from each other. Cached data needed by several groups
+    are computed only once; see :func:`.caching.lock`. An exception in one variant does
+    not stop the others; its traceback is printed as soon as the variant fails, and
+    again in the summary. If a worker process is killed, e.g. when out of memory, the
+    pool cannot be used further: the variants of all groups not yet completed fail.
+
+    Parameters
+    ----------
+    log_config : dict, optional
+        Logging configuration for worker processes. Messages on the console from
+        worker processes are limited to warnings and errors.
+    """
+    from . import util
+    from .common import CACHE_OPTIONS, READ_OPTIONS
+
+    results = []
+
+    def _collect(result):
+        results.append(result)
+        print(
+            f"[{len(results)}/{len(variants)}] {result['status']:4} "
+            f"{result['seconds']:7.1f} s  {result['variant']}",
+            flush=True,
+        )
+        if result["error"]:
+            print(result["error"], flush=True)
+
+    start = perf_counter()
+
+    groups = plan(variants)
+    log.info(f"{len(variants)} variants in {len(groups)} group(s) of input data")
+
+    if jobs > 1:
+        # Don't modify the caller's configuration
+        log_config = deepcopy(log_config or {"version": 1})
+        if "console" in log_config.get("handlers", {}):
+            log_config["handlers"]["console"] = dict(
+                log_config["handlers"]["console"], level="WARNING"
+            )
+        settings = dict(
+            log=log_config,
+            read=dict(READ_OPTIONS),
+            cache=dict(CACHE_OPTIONS),
+            skip_cache=util.SKIP_CACHE,
+        )
+
+        # One group per worker process, if supported
+        kwargs = dict(max_tasks_per_child=1) if sys.version_info >= (3, 11) else {}
+        with ProcessPoolExecutor(
+            jobs, initializer=_init, initargs=(settings,), **kwargs
+        ) as executor:
+            futures = {executor.submit(_run, group): group for group in groups}
+            for future in as_completed(futures):
+                try:
+                    group_results = future.result()
+                except Exception:
+                    # e.g. BrokenProcessPool, if a worker process was killed
+                    error = format_exc()
+                    group_results = [_result(v, start, error) for v in futures[future]]
+                for result in group_results:
+                    _collect(result)
+    else:
+        from .caching import MEMORY
+
+        for group in groups:
+            for result in _run(group):
+                _collect(result)
+        log.info(MEMORY.summary())
+
+    # Summary table
+    summary = pd.DataFrame(results, columns=["status", "seconds", "variant", "error"])
+    failed = summary.query("status != 'ok'")
+    print(
+        "",
+        f"{len(summary) - len(failed)} succeeded, {len(failed)} failed in "
+        f"{perf_counter() - start:.1f} s using {jobs} job(s)",
+        summary.drop(columns="error").to_string(index=False),
+        sep="\n",
+    )
+    if len(failed):
+        print("", "Failed:", *failed["variant"], sep="\n")
+
+    return results
@@ -1,12 +1,17 @@
+import hashlib
+import json
 import logging
-from typing import Callable
+import os
+from functools import partial
+from pathlib import Path
+from threading import get_ident
+from typing import Any, Callable, Dict, List, Optional
 
-import genno.caching
 import pandas as pd
 import pint
 from iam_units import registry
 
-from .common import DATA_PATH, SKIP_CACHE
+from .common import DATA_PATH, READ_OPTIONS, SKIP_CACHE  # noqa: F401
 
 log = logging.getLogger(__name__)
 
@@ -14,16 +19,201 @@ log = logging.getLogger(__name__)
 registry.define("bn = 10**9")
 
 
-def cached(func: Callable) -> Callable:
+def cached(func: Callable = None, *, unordered: bool = False) -> Callable:
     """Decorator to cache selected data.
 
-    Uses genno; see
-    https://genno.readthedocs.io/en/latest/cache.html#genno.caching.decorate.
+    Uses :func:`.caching.decorate`, which is compatible with
+    https://genno.readthedocs.io/en/latest/cache.html#genno.caching.decorate, and also
+    holds recent values in memory. Use as ``@cached`` or, for functions whose results
+    do not depend on the order of values in list arguments, ``@cached(unordered=True)``.
     """
-    # TODO check that this works when SKIP_CACHE changes after the method is decorated
-    return genno.caching.decorate(
-        func, cache_path=DATA_PATH / "cache", cache_skip=SKIP_CACHE
+    from .caching import decorate
+
+    if func is None:
+        return partial(cached, unordered=unordered)
+    return decorate(func, unordered)
+
+
+def is_cached(func: Callable, **kwargs) -> bool:
+    """Return :obj:`True` if the cache holds a result of `func`, decorated with
+    :func:`cached`, for `kwargs`.
+    """
+    from .caching import cache_files, cache_name, sorted_values
+
+    if getattr(func, "unordered", False):
+        kwargs = sorted_values(kwargs)
+    name = cache_name(getattr(func, "__wrapped__", func), **kwargs)
+    return len(cache_files(name)) > 0
+
+
+def write_atomic(path: Path, write: Callable[[Path], Any]) -> None:
+    """Call `write` with a temporary path, then rename the result to `path`.
+
+    An interrupted write leaves either the previous contents of `path`, or none. The
+    temporary path is unique to the process and thread.
+    """
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.part")
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def subsets_path(func: Callable) -> Path:
+    """Return the path of the index of filters for cached results of `func`."""
+    return DATA_PATH / "cache" / f"{func.__name__}.subsets.json"
+
+
+def read_subsets(func: Callable) -> List[Dict]:
+    """Return the index of filters for cached results of `func`.
+
+    Each entry is a dict with the keys:
+
+    - "key": the other arguments of the call, serialized to JSON.
+    - "variable": list of variables.
+    - "year": list of years, or :obj:`None` for all years.
+    """
+    try:
+        return json.loads(subsets_path(func).read_text())
+    except FileNotFoundError:
+        return []
+
+
+def add_subset(func: Callable, entry: Dict) -> None:
+    """Add `entry` to the index of filters for cached results of `func`."""
+    from .caching import lock
+
+    path = subsets_path(func)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with lock(path.name):
+        # Read again while holding the lock, to keep entries added by other processes
+        entries = read_subsets(func)
+        if entry in entries:
+            return
+        entries.append(entry)
+        write_atomic(path, lambda tmp: tmp.write_text(json.dumps(entries)))
+
+
+#: Size of chunks read by :func:`fingerprint`.
+FINGERPRINT_CHUNK = 2 ** 20
+
+
+def fingerprint(path) -> str:
+    """Return a hash of the contents of the file at `path`.
+
+    The hash is used in cache keys instead of the file's modification time, so that
+    cached data remain valid if the file is copied or touched, and not if its contents
+    change.
+
+    The file is read in chunks and hashed only once. The hash is stored in
+    :file:`data/cache/fingerprints.json`, keyed by the inode, size, and modification
+    time of the file, and reused while these are unchanged.
+    """
+    from .caching import lock
+
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = f"{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    index_path = DATA_PATH / "cache" / "fingerprints.json"
+
+    def _read_index():
+        try:
+            return json.loads(index_path.read_text())
+        except FileNotFoundError:
+            return {}
+
+    try:
+        return _read_index()[key]["hash"]
+    except KeyError:
+        pass
+
+    log.info(f"Compute fingerprint of {path}")
+    h = hashlib.blake2b(digest_size=16)
+    buffer = bytearray(FINGERPRINT_CHUNK)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    digest = h.hexdigest()
+
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with lock(index_path.name):
+        # - Read again while holding the lock, to keep entries added by other
+        #   processes.
+        # - Replace any entries for earlier versions of the same file.
+        index = _read_index()
+        index = {k: v for k, v in index.items() if v["path"] != str(path)}
+        index[key] = dict(path=str(path), hash=digest)
+        text = json.dumps(index, indent=2)
+        write_atomic(index_path, lambda tmp: tmp.write_text(text))
+
+    return digest
+
+
+def read_csv(
+    path,
+    dtype: Optional[Dict] = None,
+    index_col: Optional[int] = None,
+    usecols: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Read a CSV file at `path` using the engine given by :data:`.READ_OPTIONS`.
+
+    - "pandas": :func:`pandas.read_csv`, i.e. the default, single-threaded C parser.
+    - "arrow": the multi-threaded CSV reader from :mod:`pyarrow`. Columns with `dtype`
+      "category" are dictionary-encoded as they are parsed, and converted to
+      categoricals without copying. Columns with names like years, i.e. in ‘wide’
+      format, are read as floats unless given in `dtype`, as with pandas; otherwise
+      those that are entirely empty would have type null, and be returned as objects.
+
+    Parameters
+    ----------
+    dtype : dict
+        Mapping from column names to "category", :class:`str`, :class:`int`, or
+        :class:`float`.
+    index_col : int, optional
+        Column to use as the index.
+    usecols : list of str, optional
+        Names of columns to parse; others are skipped. All must appear in the file.
+    """
+    if READ_OPTIONS["engine"] == "pandas":
+        return pd.read_csv(path, dtype=dtype, index_col=index_col, usecols=usecols)
+
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    # Equivalents of `dtype` values
+    types = {
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        str: pa.string(),
+        int: pa.int64(),
+        float: pa.float64(),
+    }
+
+    column_types = {
+        name: pa.float64()
+        for name in pd.read_csv(path, nrows=0).columns
+        if name.isdigit()
+    }
+    column_types.update({name: types[t] for name, t in (dtype or {}).items()})
+
+    table = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=usecols,
+            # Treat empty strings as missing, like pandas
+            strings_can_be_null=True,
+        ),
     )
+    result = table.to_pandas(split_blocks=True)
+
+    return result if index_col is None else result.set_index(result.columns[index_col])
 
 
 def groupby_multi(dfs, *args, skip_first_empty=True, **kwargs):